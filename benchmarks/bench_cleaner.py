@@ -0,0 +1,146 @@
+'''
+Benchmarks cleaning stages on synthetic registry data.
+
+Generates registry data dir, serves it with stand-in registry (or real one given by ``--registry-bin``)
+and times listing, selection, untagging, empty repositories sweep and garbage collection.
+Results are printed as JSON, so runs of different versions can be compared.
+
+Run with ``python benchmarks/bench_cleaner.py --repositories 100 --tags 50 --output results.json``.
+
+.. moduleauthor:: Arkadiusz Dzięgiel <arkadiusz.dziegiel@glorpen.pl>
+'''
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import pkg_resources
+from collections import OrderedDict
+from glorpen.docker_registry_cleaner.console import Cli
+
+import synthetic
+
+stand_in_bin = os.path.join(os.path.dirname(os.path.abspath(__file__)), "registry_stand_in.py")
+
+def generate_config(naming, keep):
+    """Returns cleaner config keeping given number of tags in each repository."""
+    cleaners = OrderedDict()
+    if naming in ("semver", "mixed"):
+        cleaners["versions"] = {"type": "semver", "max_items": keep, "groups": {
+            "current": {"where": {"major": "latest"}, "preserve": {"patch": keep}},
+            "archival": {"where": {"major": {"max": "latest - 1"}}, "preserve": {"minor": 1, "patch": 1}},
+        }}
+    if naming in ("ci", "mixed"):
+        cleaners["ci"] = {"type": "pattern", "pattern": "ci", "max_items": keep}
+    cleaners["latest"] = {"type": "pattern", "pattern": "latest"}
+    cleaners["other"] = {"type": "max", "max_items": 0}
+
+    return {
+        "patterns": {"ci": {"build-([0-9]+)": "\\1"}, "latest": ["latest"]},
+        "repositories": {"all": {"paths": ["*"], "cleaners": cleaners}},
+    }
+
+class Stages(object):
+    """Runs and times benchmarked stages."""
+
+    def __init__(self):
+        super(Stages, self).__init__()
+        self.times = OrderedDict()
+
+    def run(self, name, f, *args, **kwargs):
+        start = time.perf_counter()
+        ret = f(*args, **kwargs)
+        self.times[name] = time.perf_counter() - start
+        print("%-20s %10.4f s" % (name, self.times[name]), file=sys.stderr)
+        return ret
+
+def select_all(app):
+    untagger = app._storage_untagger
+    selected = OrderedDict()
+    for repo in app._storage.iter_repositories():
+        cleaner = untagger.get_supported_cleaner(repo)
+        tags = app._storage.get_tags(repo)
+        selected[repo] = cleaner.select_tags(tags) if cleaner and tags else set()
+    return selected
+
+def run(ns, data_dir):
+    stages = Stages()
+    data = stages.run("generate", synthetic.generate_storage, data_dir,
+        repositories=ns.repositories, tags=ns.tags, naming=ns.naming, sharing=ns.sharing,
+        layers=ns.layers, layer_size=ns.layer_size, empty=ns.empty, seed=ns.seed
+    )
+
+    with tempfile.NamedTemporaryFile("wt", suffix=".yml") as f:
+        # JSON is valid YAML and keeps order of cleaners
+        json.dump(generate_config(ns.naming, ns.keep), f)
+        f.flush()
+        app = Cli().create_app(f.name, data_dir, ns.registry_bin)
+
+    try:
+        stages.run("listing_offline", app._storage_untagger.list_repos)
+        selected = stages.run("selection", select_all, app)
+        stages.run("estimate", app._estimator.estimate, selected, jobs=ns.jobs)
+
+        if ns.offline:
+            stages.run("untagging", app._storage_untagger.clean, jobs=ns.jobs)
+        else:
+            with app._native.run():
+                stages.run("listing", app._untagger.list_repos)
+                stages.run("untagging", app._untagger.clean, jobs=ns.jobs)
+                connections = app._untagger.registry.get_connection_stats()
+
+        if ns.gc == "native":
+            stages.run("gc", app._gc.collect, jobs=ns.jobs)
+        else:
+            stages.run("gc", app._native.garbage_collect)
+            stages.run("sweep", app._storage.remove_repositories_without_tags, jobs=ns.jobs)
+    finally:
+        app.close()
+
+    return OrderedDict([
+        ("version", pkg_resources.get_distribution("docker-registry-cleaner").version),
+        ("python", platform.python_version()),
+        ("parameters", OrderedDict((k, getattr(ns, k)) for k in ("repositories", "tags", "naming", "sharing", "layers", "layer_size", "empty", "keep", "jobs", "offline", "gc", "seed"))),
+        ("data", data),
+        ("selected_tags", sum(len(i) for i in selected.values())),
+        ("requests", None if ns.offline else connections),
+        ("stages", stages.times),
+        ("metrics", app.metrics.get_report()),
+    ])
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repositories", type=int, default=100)
+    parser.add_argument("--tags", type=int, default=50, help="Number of tags in each repository")
+    parser.add_argument("--naming", choices=synthetic.naming_schemes, default="semver")
+    parser.add_argument("--sharing", type=float, default=0.5, help="Probability of image using shared base layer")
+    parser.add_argument("--layers", type=int, default=3)
+    parser.add_argument("--layer-size", type=int, default=256)
+    parser.add_argument("--empty", type=float, default=0.1, help="Fraction of repositories without tags")
+    parser.add_argument("--keep", type=int, default=5, help="Number of tags kept by each cleaner group")
+    parser.add_argument("-j", "--jobs", type=int, default=4)
+    parser.add_argument("-o", "--offline", action="store_true", help="Untag directly in registry data dir")
+    parser.add_argument("-g", "--gc", choices=("registry", "native"), default="native")
+    parser.add_argument("-b", "--registry-bin", default=stand_in_bin)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--data-dir", default=None, help="Directory to generate data in, temporary one is used by default")
+    parser.add_argument("--output", default=None, help="File to write JSON results to, stdout by default")
+    ns = parser.parse_args()
+
+    if ns.data_dir:
+        results = run(ns, ns.data_dir)
+    else:
+        with tempfile.TemporaryDirectory() as d:
+            results = run(ns, d)
+
+    if ns.output:
+        with open(ns.output, "wt") as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+'''
+Benchmarks matching tags against pattern groups.
+
+Run with ``python benchmarks/bench_patterns.py``.
+
+.. moduleauthor:: Arkadiusz Dzięgiel <arkadiusz.dziegiel@glorpen.pl>
+'''
+import argparse
+import random
+import re
+from glorpen.docker_registry_cleaner.selectors import simple
+from synthetic import measure
+
+def generate_patterns(count):
+    """Generates group of patterns with replacements, like ones used for CI build tags."""
+    return tuple((re.compile("%s-([0-9]+)" % name), "\\1") for name in ("ci%02d" % i for i in range(count)))
+
+def generate_tags(count, patterns_count, seed=0):
+    rnd = random.Random(seed)
+    tags = []
+    for _i in range(count):
+        if rnd.random() < 0.8:
+            tags.append("ci%02d-%d" % (rnd.randrange(patterns_count), rnd.randint(0, 100000)))
+        else:
+            tags.append("feature-%08x" % rnd.getrandbits(32))
+    return tags
+
+def run(sizes, patterns_count, repeat):
+    matcher = simple.PatternMatcher(generate_patterns(patterns_count))
+    results = []
+
+    for size in sizes:
+        tags = generate_tags(size, patterns_count)
+        assert [matcher.match(t) for t in tags] == [matcher._match_sequential(t) for t in tags]
+
+        results.append({
+            "tags": size,
+            "patterns": patterns_count,
+            "combined": measure(lambda: [matcher.match(t) for t in tags], repeat),
+            "sequential": measure(lambda: [matcher._match_sequential(t) for t in tags], repeat),
+        })
+
+    return results
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--patterns", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=3)
+    ns = parser.parse_args()
+
+    print("%10s %10s %14s %14s" % ("tags", "patterns", "combined [s]", "sequential [s]"))
+    for r in run(ns.sizes, ns.patterns, ns.repeat):
+        print("%10d %10d %14.4f %14.4f" % (r["tags"], r["patterns"], r["combined"], r["sequential"]))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,401 @@
+#!/usr/bin/env python3
+'''
+Stand-in for registry binary, serving registry data dir through subset of Docker Registry v2 API.
+
+Supports ``serve`` and ``garbage-collect`` commands with the same config file as registry binary,
+so it can be used as ``--registry-bin`` when benchmarking without real registry.
+Listing, manifests (including manifest lists), blob uploads with cross-repository mounts and deletes are supported,
+authentication and layer downloads are not.
+
+.. moduleauthor:: Arkadiusz Dzięgiel <arkadiusz.dziegiel@glorpen.pl>
+'''
+import sys
+import os
+import json
+import hashlib
+import uuid
+import shutil
+import re
+import threading
+import datetime
+import yaml
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from urllib.parse import urlsplit, parse_qs, quote
+
+list_media_types = (
+    "application/vnd.docker.distribution.manifest.list.v2+json",
+    "application/vnd.oci.image.index.v1+json",
+)
+default_media_type = "application/vnd.docker.distribution.manifest.v2+json"
+
+class Store(object):
+    """Reads and writes registry data dir in layout used by registry filesystem driver."""
+
+    def __init__(self, root):
+        super(Store, self).__init__()
+
+        self.root = os.path.join(root, "docker/registry/v2")
+        self.lock = threading.RLock()
+
+    def blob_path(self, digest):
+        hex_digest = digest.split(":", 1)[1]
+        return os.path.join(self.root, "blobs/sha256", hex_digest[:2], hex_digest, "data")
+
+    def repository_path(self, repository):
+        return os.path.join(self.root, "repositories", repository)
+
+    def link_path(self, repository, kind, digest):
+        return os.path.join(self.repository_path(repository), kind, "sha256", digest.split(":", 1)[1], "link")
+
+    def tag_path(self, repository, tag):
+        return os.path.join(self.repository_path(repository), "_manifests/tags", tag)
+
+    def upload_path(self, repository, upload):
+        return os.path.join(self.repository_path(repository), "_uploads", upload)
+
+    def write(self, path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(data)
+
+    def read(self, path):
+        with open(path, "rb") as f:
+            return f.read()
+
+    def put_blob(self, data):
+        digest = "sha256:%s" % hashlib.sha256(data).hexdigest()
+        path = self.blob_path(digest)
+        if not os.path.exists(path):
+            self.write(path, data)
+        return digest
+
+    def link(self, repository, kind, digest):
+        self.write(self.link_path(repository, kind, digest), digest.encode())
+
+    def has_link(self, repository, kind, digest):
+        return os.path.exists(self.link_path(repository, kind, digest))
+
+    def get_repositories(self):
+        base = os.path.join(self.root, "repositories")
+        repositories = []
+        for path, dirs, _files in os.walk(base):
+            if "_manifests" in dirs:
+                repositories.append(os.path.relpath(path, base))
+            dirs[:] = sorted(i for i in dirs if not i.startswith("_"))
+        return sorted(repositories)
+
+    def get_tags(self, repository):
+        """Returns sorted tags of repository or ``None`` when repository does not exist."""
+        if not os.path.isdir(self.repository_path(repository)):
+            return None
+        try:
+            return sorted(os.listdir(os.path.join(self.repository_path(repository), "_manifests/tags")))
+        except FileNotFoundError:
+            return []
+
+    def get_tag_digest(self, repository, tag):
+        try:
+            return self.read(os.path.join(self.tag_path(repository, tag), "current/link")).decode()
+        except FileNotFoundError:
+            return None
+
+    def get_references(self, digest):
+        """Returns blobs and child manifests referenced by manifest."""
+        try:
+            manifest = json.loads(self.read(self.blob_path(digest)).decode())
+        except (FileNotFoundError, ValueError):
+            return [], []
+
+        if manifest.get("mediaType") in list_media_types:
+            return [], [i["digest"] for i in manifest.get("manifests", [])]
+
+        return [manifest["config"]["digest"]] + [i["digest"] for i in manifest.get("layers", [])], []
+
+def paginate(items, query):
+    """Returns page of items selected by ``n`` and ``last`` query parameters and whether there are more items."""
+    size = int(query.get("n", ["0"])[0] or 0)
+    last = query.get("last", [None])[0]
+    if last:
+        items = [i for i in items if i > last]
+
+    if size and len(items) > size:
+        return items[:size], True
+    return items, False
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    _re_path = re.compile(r"^/v2/(.+)/(tags/list|manifests/[^/]+|blobs/uploads/[^/]*|blobs/[^/]+)$")
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status, body=b"", headers=None, head=False):
+        headers = dict(headers or {})
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode()
+            headers["Content-Type"] = "application/json"
+
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+
+        if not head and body:
+            self.wfile.write(body)
+
+    def _send_error(self, status, code, head=False, **details):
+        self._send(status, {"errors": [dict(details, code=code)]}, head=head)
+
+    def _read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def _paginate(self, items, query, url):
+        """Returns page of items and headers linking to next one."""
+        page, more = paginate(items, query)
+        headers = {}
+        if more:
+            headers["Link"] = '<%s?last=%s&n=%s>; rel="next"' % (url, quote(page[-1]), query["n"][0])
+        return page, headers
+
+    def _route(self, method):
+        store = self.server.store
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+        head = method == "HEAD"
+
+        if url.path in ("/v2/", "/v2"):
+            return self._send(200, {}, head=head)
+
+        if url.path == "/v2/_catalog":
+            repositories, headers = self._paginate(store.get_repositories(), query, "/v2/_catalog")
+            return self._send(200, {"repositories": repositories}, headers)
+
+        m = self._re_path.match(url.path)
+        if not m:
+            return self._send_error(404, "NOT_FOUND")
+
+        repository, endpoint = m.groups()
+        with store.lock:
+            if endpoint == "tags/list":
+                tags = store.get_tags(repository)
+                if tags is None:
+                    return self._send_error(404, "NAME_UNKNOWN")
+                tags, headers = self._paginate(tags, query, "/v2/%s/tags/list" % repository)
+                return self._send(200, {"name": repository, "tags": tags or None}, headers)
+
+            if endpoint.startswith("manifests/"):
+                return self._manifest(method, store, repository, endpoint.split("/", 1)[1])
+
+            if endpoint.startswith("blobs/uploads/"):
+                return self._upload(method, store, repository, endpoint.split("/", 2)[2], query)
+
+            digest = endpoint.split("/", 1)[1]
+            if store.has_link(repository, "_layers", digest) and os.path.exists(store.blob_path(digest)):
+                return self._send(200, store.read(store.blob_path(digest)), {"Docker-Content-Digest": digest}, head=head)
+            return self._send_error(404, "BLOB_UNKNOWN", head=head)
+
+    def _manifest(self, method, store, repository, reference):
+        if method in ("GET", "HEAD"):
+            return self._get_manifest(store, repository, reference, head=method == "HEAD")
+        if method == "PUT":
+            return self._put_manifest(store, repository, reference)
+        if method == "DELETE":
+            return self._delete_manifest(store, repository, reference)
+        return self._send(405)
+
+    def _get_manifest(self, store, repository, reference, head):
+        digest = reference if reference.startswith("sha256:") else store.get_tag_digest(repository, reference)
+        if not digest or not store.has_link(repository, "_manifests/revisions", digest):
+            return self._send_error(404, "MANIFEST_UNKNOWN", head=head)
+
+        data = store.read(store.blob_path(digest))
+        media_type = json.loads(data.decode()).get("mediaType", default_media_type)
+        # registry converts lists to single manifest for old clients, which is not supported here
+        if media_type in list_media_types and media_type not in self.headers.get("Accept", ""):
+            return self._send_error(404, "MANIFEST_UNKNOWN", head=head, message="list not accepted")
+
+        return self._send(200, data, {"Docker-Content-Digest": digest, "Content-Type": media_type}, head=head)
+
+    def _put_manifest(self, store, repository, reference):
+        data = self._read_body()
+        manifest = json.loads(data.decode())
+
+        if manifest.get("mediaType") in list_media_types:
+            required = [(i["digest"], "_manifests/revisions") for i in manifest.get("manifests", [])]
+        else:
+            blobs = [manifest["config"]["digest"]] + [i["digest"] for i in manifest.get("layers", [])]
+            required = [(i, "_layers") for i in blobs]
+
+        for digest, kind in required:
+            if not store.has_link(repository, kind, digest):
+                return self._send_error(400, "MANIFEST_BLOB_UNKNOWN", detail=digest)
+
+        digest = store.put_blob(data)
+        store.link(repository, "_manifests/revisions", digest)
+
+        if not reference.startswith("sha256:"):
+            tag_path = store.tag_path(repository, reference)
+            store.write(os.path.join(tag_path, "current/link"), digest.encode())
+            store.write(os.path.join(tag_path, "index/sha256", digest.split(":", 1)[1], "link"), digest.encode())
+
+        return self._send(201, b"", {"Docker-Content-Digest": digest, "Location": "/v2/%s/manifests/%s" % (repository, digest)})
+
+    def _delete_manifest(self, store, repository, digest):
+        if not store.has_link(repository, "_manifests/revisions", digest):
+            return self._send_error(404, "MANIFEST_UNKNOWN")
+
+        shutil.rmtree(os.path.dirname(store.link_path(repository, "_manifests/revisions", digest)))
+        for tag in store.get_tags(repository) or []:
+            if store.get_tag_digest(repository, tag) == digest:
+                shutil.rmtree(store.tag_path(repository, tag))
+
+        return self._send(202)
+
+    def _upload(self, method, store, repository, upload, query):
+        host = "http://%s:%s" % self.server.server_address[:2]
+
+        if method == "POST":
+            if "mount" in query:
+                digest, source = query["mount"][0], query.get("from", [""])[0]
+                if store.has_link(source, "_layers", digest) and os.path.exists(store.blob_path(digest)):
+                    store.link(repository, "_layers", digest)
+                    return self._send(201, b"", {
+                        "Location": "%s/v2/%s/blobs/%s" % (host, repository, digest),
+                        "Docker-Content-Digest": digest,
+                    })
+
+            upload = str(uuid.uuid4())
+            upload_path = store.upload_path(repository, upload)
+            store.write(os.path.join(upload_path, "startedat"), datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ").encode())
+            store.write(os.path.join(upload_path, "data"), b"")
+            return self._send(202, b"", {
+                "Location": "%s/v2/%s/blobs/uploads/%s?_state=x" % (host, repository, upload),
+                "Docker-Upload-UUID": upload,
+            })
+
+        if method == "PUT":
+            upload_path = store.upload_path(repository, upload)
+            if not os.path.isdir(upload_path):
+                return self._send_error(404, "BLOB_UPLOAD_UNKNOWN")
+
+            data = store.read(os.path.join(upload_path, "data")) + self._read_body()
+            digest = query["digest"][0]
+            if "sha256:%s" % hashlib.sha256(data).hexdigest() != digest:
+                return self._send_error(400, "DIGEST_INVALID")
+
+            store.put_blob(data)
+            store.link(repository, "_layers", digest)
+            shutil.rmtree(upload_path)
+            return self._send(201, b"", {"Docker-Content-Digest": digest, "Location": "/v2/%s/blobs/%s" % (repository, digest)})
+
+        return self._send(405)
+
+    def do_GET(self):
+        self._route("GET")
+
+    def do_HEAD(self):
+        self._route("HEAD")
+
+    def do_PUT(self):
+        self._route("PUT")
+
+    def do_POST(self):
+        self._route("POST")
+
+    def do_DELETE(self):
+        self._route("DELETE")
+
+    def do_PATCH(self):
+        self._route("PATCH")
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+def serve(root, address):
+    host, port = address.rsplit(":", 1)
+    server = Server((host, int(port)), Handler)
+    server.store = Store(root)
+
+    # registry wrapper waits for this line before using API
+    sys.stderr.write('time="now" level=info msg="listening on %s"\n' % address)
+    sys.stderr.flush()
+    server.serve_forever()
+
+def garbage_collect(root, delete_untagged, dry_run):
+    """Marks and sweeps blobs, printing the same output as ``registry garbage-collect``."""
+    store = Store(root)
+    marked = set()
+    untagged = []
+
+    for repository in store.get_repositories():
+        print(repository)
+
+        revisions_path = os.path.join(store.repository_path(repository), "_manifests/revisions/sha256")
+        tagged = set(filter(None, (store.get_tag_digest(repository, t) for t in store.get_tags(repository) or [])))
+        try:
+            revisions = ["sha256:%s" % i for i in sorted(os.listdir(revisions_path))]
+        except FileNotFoundError:
+            revisions = []
+
+        children = set()
+        for digest in revisions:
+            if digest in tagged:
+                children.update(store.get_references(digest)[1])
+
+        for digest in revisions:
+            if delete_untagged and digest not in tagged and digest not in children:
+                print("manifest eligible for deletion: %s" % digest)
+                untagged.append((repository, digest))
+                continue
+
+            print("%s: marking manifest %s " % (repository, digest))
+            marked.add(digest)
+            for blob in store.get_references(digest)[0]:
+                print("%s: marking blob %s" % (repository, blob))
+                marked.add(blob)
+
+    if not dry_run:
+        for repository, digest in untagged:
+            path = os.path.dirname(store.link_path(repository, "_manifests/revisions", digest))
+            sys.stderr.write('time="now" level=info msg="deleting manifest: %s"\n' % path)
+            shutil.rmtree(path, ignore_errors=True)
+
+    blobs = set()
+    blobs_path = os.path.join(store.root, "blobs/sha256")
+    if os.path.isdir(blobs_path):
+        for prefix in os.listdir(blobs_path):
+            blobs.update("sha256:%s" % i for i in os.listdir(os.path.join(blobs_path, prefix)))
+
+    unreferenced = blobs.difference(marked)
+    print("\n%d blobs marked, %d blobs and %d manifests eligible for deletion" % (len(marked), len(unreferenced), len(untagged)))
+
+    for digest in sorted(unreferenced):
+        print("blob eligible for deletion: %s" % digest)
+        if dry_run:
+            continue
+        path = os.path.dirname(store.blob_path(digest))
+        sys.stderr.write('time="now" level=info msg="Deleting blob: %s" go.version=go1.11.2\n' % path)
+        shutil.rmtree(path)
+
+    sys.stdout.flush()
+
+def main(argv):
+    command, config_path = argv[1], argv[2]
+    with open(config_path) as f:
+        config = yaml.safe_load(f)
+
+    root = config["storage"]["filesystem"]["rootdirectory"]
+    if command == "serve":
+        serve(root, config["http"]["addr"])
+    elif command == "garbage-collect":
+        garbage_collect(root, "--delete-untagged=true" in argv or "-m" in argv, "--dry-run" in argv or "-d" in argv)
+    else:
+        sys.exit(2)
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,136 @@
+'''
+Generates synthetic registry data dirs for benchmarks and times benchmarked calls.
+
+Layout follows the one used by registry filesystem driver, so generated data can be read both by
+:class:`glorpen.docker_registry_cleaner.native.RegistryStorage` and by stand-in registry.
+
+.. moduleauthor:: Arkadiusz Dzięgiel <arkadiusz.dziegiel@glorpen.pl>
+'''
+import hashlib
+import json
+import os
+import random
+import shutil
+import time
+
+naming_schemes = ("semver", "ci", "mixed")
+
+def measure(f, repeat):
+    """Returns best wall time of calling ``f`` given number of times, in seconds."""
+    best = None
+    for _i in range(repeat):
+        start = time.perf_counter()
+        f()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def generate_tag(rnd, naming, index):
+    """Generates unique tag name for given naming scheme."""
+    if naming == "mixed":
+        naming = rnd.choice(("semver", "ci"))
+    if naming == "semver":
+        return "%d.%d.%d" % (index // 100, (index // 10) % 10, index % 10)
+    return "build-%d" % index
+
+class StorageGenerator(object):
+    """Writes blobs, manifests and links of generated repositories."""
+
+    def __init__(self, root, seed=0):
+        super(StorageGenerator, self).__init__()
+
+        self.root = "%s/docker/registry/v2" % root
+        self.rnd = random.Random(seed)
+        self.blobs = set()
+        self.bytes = 0
+
+    def _write(self, path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(data)
+
+    def put_blob(self, data):
+        digest = "sha256:%s" % hashlib.sha256(data).hexdigest()
+        if digest not in self.blobs:
+            self._write("%s/blobs/sha256/%s/%s/data" % (self.root, digest[7:9], digest[7:]), data)
+            self.blobs.add(digest)
+            self.bytes += len(data)
+        return digest
+
+    def link(self, repository, kind, digest):
+        self._write("%s/repositories/%s/%s/sha256/%s/link" % (self.root, repository, kind, digest[7:]), digest.encode())
+
+    def random_blob(self, size):
+        return self.put_blob(self.rnd.getrandbits(size * 8).to_bytes(size, "little"))
+
+    def put_image(self, repository, layers):
+        config = self.put_blob(json.dumps({"repository": repository, "id": self.rnd.getrandbits(64)}).encode())
+        manifest = json.dumps({
+            "schemaVersion": 2,
+            "mediaType": "application/vnd.docker.distribution.manifest.v2+json",
+            "config": {"mediaType": "application/vnd.docker.container.image.v1+json", "size": 0, "digest": config},
+            "layers": [{"mediaType": "application/vnd.docker.image.rootfs.diff.tar.gzip", "size": 0, "digest": d} for d in layers],
+        }).encode()
+        digest = self.put_blob(manifest)
+
+        for d in layers + [config]:
+            self.link(repository, "_layers", d)
+        self.link(repository, "_manifests/revisions", digest)
+
+        return digest
+
+    def tag(self, repository, tag, digest):
+        path = "%s/repositories/%s/_manifests/tags/%s" % (self.root, repository, tag)
+        self._write("%s/current/link" % path, digest.encode())
+        self._write("%s/index/sha256/%s/link" % (path, digest[7:]), digest.encode())
+
+    def untag_all(self, repository):
+        """Leaves repository without tags, as after removing all of them through registry API."""
+        path = "%s/repositories/%s/_manifests/tags" % (self.root, repository)
+        shutil.rmtree(path)
+        os.makedirs(path)
+
+def generate_storage(root, repositories=100, tags=50, naming="semver", sharing=0.5, layers=3, layer_size=256, empty=0.1, seed=0):
+    """Generates registry data dir.
+
+    :param repositories: Number of repositories, half of them nested in groups.
+    :param tags: Number of tags in each repository.
+    :param naming: Tag naming scheme, one of :data:`naming_schemes`.
+    :param sharing: Probability of image using base layer shared by all repositories.
+    :param layers: Number of unique layers per image.
+    :param layer_size: Size of each layer in bytes.
+    :param empty: Fraction of repositories left without tags.
+    :returns: Generated data stats.
+    :rtype: dict
+    """
+    if naming not in naming_schemes:
+        raise Exception('Unknown naming scheme %r, available: %r' % (naming, naming_schemes))
+
+    g = StorageGenerator(root, seed)
+    base_layers = [g.random_blob(layer_size) for _i in range(max(1, repositories // 10))]
+    images = 0
+
+    for r in range(repositories):
+        name = "group-%d/repo-%d" % (r % 10, r) if r % 2 else "repo-%d" % r
+
+        for t in range(tags):
+            image_layers = [g.random_blob(layer_size) for _i in range(layers)]
+            if g.rnd.random() < sharing:
+                image_layers.insert(0, g.rnd.choice(base_layers))
+            digest = g.put_image(name, image_layers)
+            images += 1
+            # some tags point to the same image, like "latest" and its version
+            g.tag(name, generate_tag(g.rnd, naming, t), digest)
+            if t == tags - 1:
+                g.tag(name, "latest", digest)
+
+        if g.rnd.random() < empty:
+            g.untag_all(name)
+
+    return {
+        "repositories": repositories,
+        "tags": tags,
+        "images": images,
+        "blobs": len(g.blobs),
+        "bytes": g.bytes,
+    }
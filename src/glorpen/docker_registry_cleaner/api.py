@@ -6,38 +6,269 @@ import fnmatch
 import hashlib
 import random
 import logging
+import concurrent.futures
+import threading
+import json
+import os
+import time
+import re
+from requests.adapters import HTTPAdapter
+from collections import OrderedDict
+from urllib.parse import urljoin
+from glorpen.docker_registry_cleaner.selectors.base import TagTable
+from glorpen.docker_registry_cleaner.metrics import Metrics
+
+class ManifestCache(object):
+    """Bounded LRU cache of manifests keyed by digest, with tag to digest lookups.
+    
+    Manifests are content addressed, so cached ones can be saved to file and reused by next runs.
+    Tag references can change outside of current run and are kept only in memory,
+    together with media types of manifests resolved without downloading them.
+    """
+    
+    _file_version = 1
+    
+    def __init__(self, max_size=16*1024*1024, max_references=65536, path=None):
+        """
+        :param max_size: Maximum size of cached manifests in bytes.
+        :type max_size: int
+        :param max_references: Maximum number of cached tag references and media types.
+        :type max_references: int
+        :param path: Optional path to file used to persist manifests between runs.
+        :type path: str
+        """
+        super(ManifestCache, self).__init__()
+        
+        self.max_size = max_size
+        self.max_references = max_references
+        self.path = path
+        self.size = 0
+        
+        self._manifests = OrderedDict()
+        self._references = OrderedDict()
+        self._tags = {}
+        self._media_types = OrderedDict()
+        self._transient = set()
+        self._lock = threading.Lock()
+        self._logger = logging.getLogger(self.__class__.__name__)
+        
+        if path and os.path.exists(path):
+            self.load()
+    
+    def __len__(self):
+        return len(self._manifests)
+    
+    def get(self, digest):
+        """Returns media type and raw manifest for given digest or ``None`` when it is not cached."""
+        with self._lock:
+            entry = self._manifests.get(digest)
+            if entry is not None:
+                self._manifests.move_to_end(digest)
+            return entry
+    
+    def set(self, digest, media_type, data, persistent=True):
+        """
+        :param persistent: Save manifest to cache file, disable for manifests used only in current run.
+        :type persistent: bool
+        """
+        if len(data) > self.max_size:
+            return
+        
+        with self._lock:
+            old = self._manifests.pop(digest, None)
+            if old:
+                self.size -= len(old[1])
+            
+            self._manifests[digest] = (media_type, data)
+            self.size += len(data)
+            
+            if persistent:
+                self._transient.discard(digest)
+            else:
+                self._transient.add(digest)
+            
+            while self.size > self.max_size:
+                evicted_digest, (_media_type, evicted) = self._manifests.popitem(last=False)
+                self._transient.discard(evicted_digest)
+                self.size -= len(evicted)
+    
+    def get_reference(self, repository, tag):
+        """Returns digest that tag was pointing to or ``None`` when unknown."""
+        with self._lock:
+            return self._references.get((repository, tag))
+    
+    def _unlink_tag(self, repository, tag, digest):
+        tags = self._tags.get((repository, digest))
+        if tags is not None:
+            tags.discard(tag)
+            if not tags:
+                del self._tags[(repository, digest)]
+    
+    def set_reference(self, repository, tag, digest):
+        with self._lock:
+            old = self._references.pop((repository, tag), None)
+            if old is not None:
+                self._unlink_tag(repository, tag, old)
+            
+            self._references[(repository, tag)] = digest
+            self._tags.setdefault((repository, digest), set()).add(tag)
+            
+            while len(self._references) > self.max_references:
+                (evicted_repository, evicted_tag), evicted = self._references.popitem(last=False)
+                self._unlink_tag(evicted_repository, evicted_tag, evicted)
+    
+    def get_media_type(self, digest):
+        """Returns media type of manifest or ``None`` when unknown."""
+        with self._lock:
+            entry = self._manifests.get(digest)
+            return entry[0] if entry else self._media_types.get(digest)
+    
+    def set_media_type(self, digest, media_type):
+        with self._lock:
+            self._media_types.pop(digest, None)
+            self._media_types[digest] = media_type
+            
+            while len(self._media_types) > self.max_references:
+                self._media_types.popitem(last=False)
+    
+    def remove_references(self, repository, digest):
+        """Forgets tags pointing to removed image."""
+        with self._lock:
+            for tag in self._tags.pop((repository, digest), ()):
+                del self._references[(repository, tag)]
+    
+    def clear(self):
+        with self._lock:
+            self._manifests.clear()
+            self._transient.clear()
+            self._references.clear()
+            self._tags.clear()
+            self._media_types.clear()
+            self.size = 0
+    
+    def load(self):
+        """Loads manifests saved by previous run, ones not matching their digest are skipped."""
+        try:
+            with open(self.path, "rt") as f:
+                d = json.load(f)
+        except ValueError:
+            self._logger.warning("Ignoring invalid manifest cache file %s", self.path)
+            return
+        
+        if d.get("version") != self._file_version:
+            return
+        
+        for digest, media_type, text in d["manifests"]:
+            data = text.encode()
+            if digest != "sha256:%s" % hashlib.sha256(data).hexdigest():
+                continue
+            self.set(digest, media_type, data)
+    
+    def save(self):
+        """Saves cached manifests to file, references and manifests used only in current run are not saved."""
+        with self._lock:
+            manifests = [
+                [digest, media_type, data.decode()]
+                for digest, (media_type, data) in self._manifests.items()
+                if digest not in self._transient
+            ]
+        
+        tmp_path = "%s.tmp" % self.path
+        with open(tmp_path, "wt") as f:
+            json.dump({"version": self._file_version, "manifests": manifests}, f)
+        os.replace(tmp_path, self.path)
 
 class DockerRegistry(object):
     """Manages single remote repository through Docker Registry API."""
     _version = "v2"
     
-    def __init__(self, url, auth=None):
+    list_media_types = (
+        'application/vnd.docker.distribution.manifest.list.v2+json',
+        'application/vnd.oci.image.index.v1+json',
+    )
+    """Types of manifests referencing other manifests, used by multi-arch images."""
+    
+    manifest_media_types = (
+        'application/vnd.docker.distribution.manifest.v2+json',
+        'application/vnd.oci.image.manifest.v1+json',
+        'application/vnd.docker.distribution.manifest.v1+prettyjws',
+    ) + list_media_types
+    """Accepted manifest types, so registry returns stored manifest without converting it."""
+    
+    retry_statuses = (429, 500, 502, 503, 504)
+    """Response statuses that idempotent requests are retried on."""
+    
+    _re_endpoint = re.compile(r'/v2/(?:_(catalog)|.+/(tags)/list|.+/(manifests)/|.+/blobs/(uploads)/|.+/(blobs)/)')
+    
+    def __init__(self, url, auth=None, page_size=None, concurrency=8, cache=None, pool_size=None, timeout=None, retries=0, backoff=0.5, metrics=None):
         """
         :param url: Docker Registry URL
         :type url: str
         :param auth: Optional user and password in format ``{"user": user, "password": password}``. 
         :type auth: dict
+        :param page_size: Optional number of entries requested per page when listing repositories and tags.
+        :type page_size: int
+        :param concurrency: Default number of requests kept in flight by bulk operations.
+        :type concurrency: int
+        :param cache: Cache for manifests and tag references, in-memory one is created when not given.
+        :type cache: ManifestCache
+        :param pool_size: Number of kept-alive connections, defaults to ``concurrency`` for each worker set by :meth:`.set_workers`.
+        :type pool_size: int
+        :param timeout: Optional connect and read timeout for each request, in seconds.
+        :type timeout: float
+        :param retries: Number of retries of idempotent requests (GET, HEAD, manifest PUT) failed by connection error or server overload.
+        :type retries: int
+        :param backoff: Delay before first retry in seconds, doubled for each next one.
+        :type backoff: float
+        :param metrics: Collector of requests counts and latencies.
+        :type metrics: Metrics
         """
         super(DockerRegistry, self).__init__()
         self.logger = logging.getLogger(self.__class__.__name__)
         self._url = url
-        self._cache = {}
-    
+        self._cache = ManifestCache() if cache is None else cache
+        self._page_size = page_size
+        self._concurrency = concurrency
+        self._pool_size = pool_size
+        self._timeout = timeout
+        self._retries = retries
+        self._backoff = backoff
+        self._retried = 0
+        self._metrics = Metrics() if metrics is None else metrics
+        
+        self._adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size or concurrency)
         self._req = requests.Session()
+        self._req.mount("http://", self._adapter)
+        self._req.mount("https://", self._adapter)
         
         self._setup()
         if auth:
             self._setup_auth(**auth)
     
+    def set_workers(self, workers):
+        """Sets number of threads using this registry at once, each one running bulk operations.
+        
+        Unless pool size was given explicitly, connection pool is resized to keep connection
+        for every request in flight, so connections are not closed and opened again.
+        """
+        if self._pool_size is None:
+            self._adapter.poolmanager.clear()
+            self._adapter.init_poolmanager(1, max(1, workers) * self._concurrency)
+    
     def _setup_auth(self, user, password):
         self._req.auth = (user, password)
     
     def _setup(self):
         self._req.headers.update({
-            'accept': 'application/vnd.docker.distribution.manifest.v2+json'
+            'accept': ", ".join(self.manifest_media_types)
         })
     
-    def _api(self, path, method="get", data=None, json=None, content_type=None):
+    def _api(self, path, method="get", data=None, json=None, content_type=None, retry=None):
+        """Sends request to registry.
+        
+        :param retry: Whether request can be retried, by default only GET and HEAD ones are.
+        :type retry: bool
+        """
         headers = {}
         if content_type:
             headers['content-type'] = content_type
@@ -47,19 +278,100 @@ class DockerRegistry(object):
         else:
             url = "%s/%s/%s" % (self._url, self._version, path)
         
-        return getattr(self._req, method)(url, headers=headers, json=json, data=data)
+        retries = self._retries if (method in ("get", "head") if retry is None else retry) else 0
+        
+        endpoint = self._get_endpoint(url)
+        
+        for attempt in range(retries + 1):
+            start = time.perf_counter()
+            try:
+                r = self._req.request(method, url, headers=headers, json=json, data=data, timeout=self._timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                self._metrics.inc("http_requests_total", endpoint=endpoint, method=method.upper(), status="error")
+                if attempt == retries:
+                    raise
+                self.logger.warning("Retrying %s %s after error: %s", method.upper(), url, e)
+            else:
+                self._metrics.observe("http_request_duration_seconds", time.perf_counter() - start, endpoint=endpoint, method=method.upper())
+                self._metrics.inc("http_requests_total", endpoint=endpoint, method=method.upper(), status=r.status_code)
+                
+                if attempt == retries or r.status_code not in self.retry_statuses:
+                    return r
+                self.logger.warning("Retrying %s %s after status %d", method.upper(), url, r.status_code)
+                r.close()
+            
+            self._retried += 1
+            time.sleep(self._backoff * 2 ** attempt)
+    
+    def _get_endpoint(self, url):
+        """Returns name of API endpoint used in metrics."""
+        m = self._re_endpoint.search(url)
+        if m is None:
+            return "base"
+        return m.group(m.lastindex)
+    
+    def get_connection_stats(self):
+        """Returns number of sent requests, opened connections and retried requests.
+        
+        Requests sent over already opened connections are ``requests - connections``.
+        
+        :rtype: dict
+        """
+        stats = {"requests": 0, "connections": 0, "retries": self._retried}
+        pools = self._adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                stats["requests"] += pool.num_requests
+                stats["connections"] += pool.num_connections
+        return stats
     
     def check(self):
         """Checks wheter we can connect to registry."""
-        return self._api("").status_code == 200
+        return self._api("", "head").status_code == 200
+    
+    def _iter_pages(self, path, key, missing_ok=False):
+        """Yields items from paginated listing, following ``Link`` headers returned by registry.
+        
+        Failed page is raised as :class:`requests.HTTPError`, so listing is never silently truncated.
+        
+        :param missing_ok: Treat not found first page as empty listing.
+        :type missing_ok: bool
+        """
+        if self._page_size:
+            path = "%s?n=%d" % (path, self._page_size)
+        
+        first = True
+        while path:
+            r = self._api(path)
+            if first and missing_ok and r.status_code == 404:
+                return
+            r.raise_for_status()
+            first = False
+            
+            yield from r.json().get(key) or []
+            
+            next_page = r.links.get("next")
+            path = urljoin(r.url, next_page["url"]) if next_page else None
+    
+    def iter_repositories(self):
+        """Iterates over repositories names, fetching next page only when needed."""
+        return self._iter_pages("_catalog", "repositories")
+    
+    def iter_tags(self, repository):
+        """Iterates over tag names for given repository, fetching next page only when needed.
+        
+        Repository without tags is reported by registry as unknown and yields nothing.
+        """
+        return self._iter_pages("%s/tags/list" % repository, "tags", missing_ok=True)
     
     def get_repositories(self):
         """List repositories names."""
-        return tuple(self._api("_catalog").json().get("repositories", tuple()))
+        return tuple(self.iter_repositories())
     
     def get_tags(self, repository):
         """List tag names for given repository."""
-        return tuple(self._api("%s/tags/list" % repository).json().get("tags") or [])
+        return tuple(self.iter_tags(repository))
     
     def remove_image(self, repository, reference):
         """Removes image by given reference."""
@@ -67,33 +379,128 @@ class DockerRegistry(object):
         
         r = self._api("%s/manifests/%s" % (repository, reference), 'delete')
         r.raise_for_status()
+        
+        self._cache.remove_references(repository, reference)
     
-    def get_reference(self, repository, tag):
-        """Returns digest for given tag."""
-        r = self._api("%s/manifests/%s" % (repository, tag))
+    def remove_images(self, repository, references, concurrency=None):
+        """Removes multiple images, keeping up to ``concurrency`` requests in flight.
+        
+        :param concurrency: Number of concurrent requests, defaults to value given in constructor.
+        :type concurrency: int
+        :returns: References that could not be removed with exception raised for each one.
+        :rtype: OrderedDict
+        """
+        failed = OrderedDict()
+        
+        with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency or self._concurrency) as executor:
+            futures = OrderedDict((executor.submit(self.remove_image, repository, ref), ref) for ref in references)
+            for f, ref in futures.items():
+                e = f.exception()
+                if e is not None:
+                    self.logger.error("Could not remove image %s@%s: %s", repository, ref, e)
+                    failed[ref] = e
+        
+        return failed
+    
+    def _head_reference(self, repository, tag, missing_ok=True):
+        r = self._api("%s/manifests/%s" % (repository, tag), "head")
+        if r.status_code == 404 and missing_ok:
+            return None
         r.raise_for_status()
-        return r.headers.get("Docker-Content-Digest")
+        
+        digest = r.headers.get("Docker-Content-Digest")
+        self._cache.set_reference(repository, tag, digest)
+        if "Content-Type" in r.headers:
+            self._cache.set_media_type(digest, r.headers["Content-Type"].split(";")[0])
+        return digest
     
-    def upload_fake_image(self, repository, tag, data=None):
+    def get_reference(self, repository, tag, cache=False):
+        """Returns digest for given tag.
         
-        self.logger.info("Uploaded fake image to %s:%s", repository, tag)
+        Digest is resolved with HEAD request, so manifest is not downloaded.
         
-        data = str(random.random()).encode() if data is None else data
+        :param cache: Use digest remembered in current run.
+        :type cache: bool
+        :raises: requests.HTTPError when tag was not found
+        """
+        digest = self._cache.get_reference(repository, tag) if cache else None
+        
+        if digest is None:
+            digest = self._head_reference(repository, tag, missing_ok=False)
+        
+        return digest
+    
+    def get_references(self, repository, tags, concurrency=None, cache=False):
+        """Returns digests for given tags, resolving up to ``concurrency`` tags at once.
+        
+        :param concurrency: Number of concurrent requests, defaults to value given in constructor.
+        :type concurrency: int
+        :param cache: Use digests remembered in current run.
+        :type cache: bool
+        :returns: Digest for each tag, ``None`` for tags that were not found.
+        :rtype: OrderedDict
+        """
+        references = OrderedDict((t, self._cache.get_reference(repository, t) if cache else None) for t in tags)
+        missing = [t for t, digest in references.items() if digest is None]
+        
+        if missing:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency or self._concurrency) as executor:
+                for t, digest in zip(missing, executor.map(lambda t: self._head_reference(repository, t), missing)):
+                    references[t] = digest
+        
+        return references
+    
+    def upload_blob(self, repository, data, mount_from=None):
+        """Uploads blob to repository.
+        
+        When ``mount_from`` repository is given, registry is asked to mount existing blob from it instead
+        and data is uploaded only when mounting is not possible.
+        
+        :returns: Digest of blob.
+        """
         digest = "sha256:%s" % hashlib.sha256(data).hexdigest()
         
+        path = "%s/blobs/uploads/" % repository
+        if mount_from:
+            path = "%s?mount=%s&from=%s" % (path, digest, mount_from)
+        
         # get location for upload and start upload session
-        r = self._api("%s/blobs/uploads/" % repository, method="post")
+        r = self._api(path, method="post")
+        r.raise_for_status()
+        
+        if r.status_code == 201:
+            self.logger.debug("Mounted blob %s from %s to %s", digest, mount_from, repository)
+            return digest
+        
         url = r.headers['Location']
         
         # upload data and end upload process
         r = self._api(
-            "%s&digest=%s" % (url, digest),
+            "%s%sdigest=%s" % (url, "&" if "?" in url else "?", digest),
             method="put",
             data=data,
             content_type="application/octet-stream"
         )
         r.raise_for_status()
         
+        return digest
+    
+    def upload_fake_image(self, repository, tag, data=None, mount_from=None, persistent=True):
+        """Creates image with single config blob and no layers.
+        
+        :param data: Config blob contents, random one is used when not given.
+        :type data: bytes
+        :param mount_from: Repository that already contains config blob, see :meth:`.upload_blob`.
+        :type mount_from: str
+        :param persistent: Save manifest to persistent cache, disable for images removed by current run.
+        :type persistent: bool
+        :returns: Digest of image manifest.
+        """
+        self.logger.info("Uploaded fake image to %s:%s", repository, tag)
+        
+        data = str(random.random()).encode() if data is None else data
+        digest = self.upload_blob(repository, data, mount_from)
+        
         d = {
             'schemaVersion': 2,
             'mediaType': 'application/vnd.docker.distribution.manifest.v2+json',
@@ -106,43 +513,141 @@ class DockerRegistry(object):
             ]
         }
         
-        # create manifest with given tag
+        # create manifest with given tag, cached so it is not downloaded again when tagging
+        manifest_data = json.dumps(d).encode()
+        manifest_digest = "sha256:%s" % hashlib.sha256(manifest_data).hexdigest()
+        self._cache.set(manifest_digest, d["mediaType"], manifest_data, persistent=persistent)
+        self._put_manifest(repository, tag, (d["mediaType"], manifest_data))
+        
+        return manifest_digest
+    
+    def clear_cache(self):
+        self._cache.clear()
+    
+    def _get_manifest(self, repository, reference, cache=False):
+        """Returns media type and raw data of manifest.
+        
+        With ``cache`` enabled manifest is read from cache when digest of reference is known,
+        when cache is not empty unknown tags are resolved by HEAD request so only missing manifests are downloaded.
+        """
+        digest = None
+        
+        if cache:
+            if ":" in reference:
+                digest = reference
+            else:
+                digest = self._cache.get_reference(repository, reference)
+                if digest is None and len(self._cache):
+                    digest = self._head_reference(repository, reference)
+            
+            manifest = self._cache.get(digest) if digest else None
+            if manifest is not None:
+                self._cache.set_reference(repository, reference, digest)
+                return manifest
+        
+        r = self._api("%s/manifests/%s" % (repository, digest or reference))
+        r.raise_for_status()
+        
+        data = r.content
+        media_type = r.headers.get("Content-Type", "").split(";")[0] or json.loads(data.decode())["mediaType"]
+        digest = r.headers.get("Docker-Content-Digest") or "sha256:%s" % hashlib.sha256(data).hexdigest()
+        
+        if cache:
+            self._cache.set(digest, media_type, data)
+            self._cache.set_reference(repository, reference, digest)
+        
+        return media_type, data
+    
+    def get_manifest(self, repository, reference, cache=True):
+        """Returns parsed manifest, image manifest or manifest list / OCI index.
+        
+        :rtype: dict
+        """
+        _media_type, data = self._get_manifest(repository, reference, cache)
+        return json.loads(data.decode())
+    
+    def _get_children(self, repository, digest):
+        media_type = self._cache.get_media_type(digest)
+        if media_type is not None and media_type not in self.list_media_types:
+            return ()
+        
+        media_type, data = self._get_manifest(repository, digest, cache=True)
+        if media_type not in self.list_media_types:
+            return ()
+        
+        return tuple(m["digest"] for m in json.loads(data.decode()).get("manifests", ()))
+    
+    def get_children(self, repository, digests, concurrency=None):
+        """Returns manifests referenced by manifest lists and OCI indexes.
+        
+        Only manifests not known to be single image ones are downloaded.
+        
+        :param digests: Digests of manifests to check.
+        :type digests: iterable
+        :param concurrency: Number of concurrent requests, defaults to value given in constructor.
+        :type concurrency: int
+        :returns: Child manifests digests for each given one, empty for image manifests.
+        :rtype: OrderedDict
+        """
+        digests = list(digests)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency or self._concurrency) as executor:
+            return OrderedDict(zip(digests, executor.map(lambda d: self._get_children(repository, d), digests)))
+    
+    def _put_manifest(self, repository, tag, manifest):
+        """Uploads raw manifest, so tagged image keeps its digest."""
+        media_type, data = manifest
         r = self._api(
             "%s/manifests/%s" % (repository, tag),
             method="put",
-            content_type=d["mediaType"],
-            json = d
+            content_type=media_type,
+            data=data,
+            retry=True
         )
         r.raise_for_status()
         
-        return r.headers['Docker-Content-Digest']
-    
-    def clear_cache(self):
-        self.cache.clear()
+        digest = r.headers.get("Docker-Content-Digest")
+        if digest:
+            self._cache.set_reference(repository, tag, digest)
     
     def tag(self, repository, source_tag, target_tag, cache=False):
         
         self.logger.info("Tagging %s:%s as %s:%s", repository, source_tag, repository, target_tag)
-        cache_key = "manifest:%s:%s" % (repository, source_tag)
         
-        if not cache or cache_key not in self._cache:
-            r = self._api("%s/manifests/%s" % (repository, source_tag))
-            r.raise_for_status()
-            manifest = r.json()
-            if cache:
-                self._cache[cache_key] = manifest
-        else:
-            manifest = self._cache[cache_key]
+        manifest = self._get_manifest(repository, source_tag, cache)
+        self._put_manifest(repository, target_tag, manifest)
+    
+    def tag_many(self, repository, source_tag, target_tags, concurrency=None, cache=True):
+        """Tags image with multiple tags, keeping up to ``concurrency`` requests in flight.
         
-        r = self._api(
-            "%s/manifests/%s" % (repository, target_tag),
-            method="put",
-            content_type=manifest["mediaType"],
-            json = manifest
-        )
-        r.raise_for_status()
+        Source manifest is fetched only once.
+        
+        :param concurrency: Number of concurrent requests, defaults to value given in constructor.
+        :type concurrency: int
+        :returns: Tags that could not be created with exception raised for each one.
+        :rtype: OrderedDict
+        """
+        manifest = self._get_manifest(repository, source_tag, cache)
+        failed = OrderedDict()
+        
+        def _tag(target_tag):
+            self.logger.info("Tagging %s:%s as %s:%s", repository, source_tag, repository, target_tag)
+            self._put_manifest(repository, target_tag, manifest)
+        
+        with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency or self._concurrency) as executor:
+            futures = OrderedDict((executor.submit(_tag, t), t) for t in target_tags)
+            for f, t in futures.items():
+                e = f.exception()
+                if e is not None:
+                    self.logger.error("Could not tag %s:%s as %s:%s: %s", repository, source_tag, repository, t, e)
+                    failed[t] = e
+        
+        return failed
     
     def close(self):
+        if self._cache.path:
+            self._cache.save()
+        
+        self.logger.debug("Connection stats: %r", self.get_connection_stats())
         self._req.close()
     
 class DockerRepository(object):
@@ -164,13 +669,11 @@ class DockerRepository(object):
     
     def select_tags(self, tags):
         """Returns tags that should be deleted."""
-        unmatched = list(sorted(tags, reverse=True))
-        
-        for_deletion = set()
+        table = TagTable(tags)
         
         for s in self.selectors.values():
-            old_unmatched = set(unmatched)
-            selected, unmatched = s.select(unmatched)
-            for_deletion.update(old_unmatched - set(unmatched) - set(selected))
-            
-        return for_deletion
+            if not table.unclaimed:
+                break
+            s.claim(table)
+        
+        return table.get_deleted()
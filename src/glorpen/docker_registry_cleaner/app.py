@@ -6,8 +6,31 @@ from glorpen.docker_registry_cleaner.parser import Loader
 import glorpen.di as di
 import importlib
 from glorpen.docker_registry_cleaner import api, native
+from glorpen.docker_registry_cleaner.metrics import Metrics
+from glorpen.docker_registry_cleaner.journal import Journal
 from collections import OrderedDict
+import concurrent.futures
 import logging
+import threading
+import random
+import time
+import json
+import os
+
+class CleaningFailed(Exception):
+    """Some repositories could not be cleaned, other ones were cleaned anyway."""
+    
+    def __init__(self, failed, cleaned):
+        """
+        :param failed: Exceptions raised for failed repositories, keyed by repository name.
+        :type failed: OrderedDict
+        :param cleaned: Tags selected for deletion in successfully cleaned repositories.
+        :type cleaned: OrderedDict
+        """
+        super(CleaningFailed, self).__init__('Cleaning failed for %d repositories: %s' % (len(failed), ", ".join(failed.keys())))
+        
+        self.failed = failed
+        self.cleaned = cleaned
 
 class SelectorFactory(object):
     def __init__(self):
@@ -46,7 +69,10 @@ class AppCompositor(object):
         
         svc = self._c.add_service(SelectorFactory)
         
+        svc = self._c.add_service(Metrics)
+        
         svc = self._c.add_service(api.DockerRegistry)
+        svc.factory(callable=self.create_registry, loader__svc=Loader, metrics__svc=Metrics)
         svc.kwargs(url="http://%s" % self.registry_address)
         
         svc = self._c.add_service("app.cleaners")
@@ -54,13 +80,20 @@ class AppCompositor(object):
         svc.kwargs(loader__svc=Loader, selector_factory__svc=SelectorFactory)
         
         svc = self._c.add_service(Untagger)
-        svc.kwargs(registry__svc=api.DockerRegistry, cleaners__svc="app.cleaners")
+        svc.kwargs(registry__svc=api.DockerRegistry, cleaners__svc="app.cleaners", metrics__svc=Metrics)
         
         svc = self._c.add_service(native.RegistryStorage)
-        svc.kwargs(registry_path=registry_data)
+        svc.kwargs(registry_path=registry_data, metrics__svc=Metrics)
+        
+        svc = self._c.add_service(StorageUntagger)
+        svc.kwargs(registry__svc=native.RegistryStorage, cleaners__svc="app.cleaners", metrics__svc=Metrics)
         
         svc = self._c.add_service(native.NativeRegistry)
-        svc.kwargs(registry_data=registry_data, registry_address=self.registry_address, registry_bin=registry_bin)
+        svc.kwargs(registry_data=registry_data, registry_address=self.registry_address, registry_bin=registry_bin, metrics__svc=Metrics)
+        
+        svc = self._c.add_service(native.GarbageCollector)
+        
+        svc = self._c.add_service(native.SpaceEstimator)
         
         svc = self._c.add_service(Cleaner)
     
@@ -83,6 +116,11 @@ class AppCompositor(object):
         svc = self._c.get_definition(Loader)
         svc.call('add_selector_schema', type_name=symbol, schema=config_schema)
     
+    def create_registry(self, loader: Loader, url, metrics):
+        kwargs = dict(loader.data["registry"])
+        kwargs["cache"] = api.ManifestCache(**kwargs["cache"])
+        return api.DockerRegistry(url, metrics=metrics, **kwargs)
+    
     def create_selector_config(self, cls, loader: Loader, config_key):
         return cls(loader.data.get(config_key))
     
@@ -115,60 +153,237 @@ class Untagger(object):
     
     fake_tag = "untagger-for-deletion"
     
-    def __init__(self, registry, cleaners):
+    digest_deletion_ratio = 0.5
+    """Minimal fraction of repository tags selected for deletion to delete images directly by digest.
+    
+    Resolving digests needs HEAD request for every tag in repository,
+    for smaller selections only removed tags are re-tagged to fake image.
+    """
+    
+    def __init__(self, registry, cleaners, metrics=None):
         super(Untagger, self).__init__()
         
         self.logger = logging.getLogger(self.__class__.__name__)
         
         self.registry = registry
         self.cleaners = cleaners
+        self.metrics = Metrics() if metrics is None else metrics
+        
+        self._fake_blob = None
+        self._fake_blob_lock = threading.Lock()
+        self._journal = None
+        
+        self.listed_repositories = 0
+        """Number of repositories listed by last run."""
     
     def get_supported_cleaner(self, repository):
         for r in self.cleaners:
             if r.supports_repo(repository):
                 return r
     
-    def delete_tags(self, registry, repo, tags):
-        fake_ref = registry.upload_fake_image(repo, self.fake_tag)
+    def _upload_fake_image(self, registry, repo):
+        """Uploads fake config blob once per run, other repositories mount it from the first one.
+        
+        Fake manifest is random, so it is not saved to persistent cache.
+        """
+        with self._fake_blob_lock:
+            if self._fake_blob is None:
+                data = str(random.random()).encode()
+                fake_ref = registry.upload_fake_image(repo, self.fake_tag, data, persistent=False)
+                self._fake_blob = (repo, data)
+                return fake_ref
+        
+        source, data = self._fake_blob
+        return registry.upload_fake_image(repo, self.fake_tag, data, mount_from=source, persistent=False)
+    
+    def _remove_fake_image(self, registry, repo):
+        """Removes fake image left by interrupted run, along with tags moved to it."""
+        fake_ref = registry.get_references(repo, [self.fake_tag])[self.fake_tag]
+        if fake_ref is not None:
+            self.logger.warning("Removing fake image left in %s", repo)
+            registry.remove_image(repo, fake_ref)
+    
+    def _split_by_digest(self, registry, repo, tags, all_tags):
+        """Returns digests referenced only by given tags and tags sharing digest with kept ones.
         
+        Manifests referenced by kept manifest lists are kept too.
+        """
+        references = registry.get_references(repo, all_tags)
+        removed = set(tags)
+        kept = set(d for t, d in references.items() if t not in removed and d is not None)
+        for children in registry.get_children(repo, kept).values():
+            kept.update(children)
+        
+        doomed = OrderedDict()
+        shared = []
         for t in tags:
-            if t == self.fake_tag:
-                continue
-            # dont delete, just tag fake image with tags for deletion
-            registry.tag(repo, self.fake_tag, t, cache=True)
+            digest = references.get(t)
+            if digest is None or digest in kept:
+                shared.append(t)
+            else:
+                doomed.setdefault(digest, []).append(t)
         
-        # will remove _image_ referenced by tag, not just tag
-        registry.remove_image(repo, fake_ref)
+        return doomed, shared
+    
+    def delete_tags(self, registry, repo, tags, all_tags=None):
+        """Removes tags from repository.
+        
+        When all tags in repository are given and enough of them are removed (see :attr:`.digest_deletion_ratio`),
+        images referenced only by removed tags are deleted directly by digest
+        and fake image is used only for tags sharing image with kept ones.
+        """
+        tags = [t for t in tags if t != self.fake_tag]
+        failed = OrderedDict()
+        
+        if all_tags is not None and len(tags) >= len(all_tags) * self.digest_deletion_ratio:
+            doomed, tags = self._split_by_digest(registry, repo, tags, all_tags)
+            
+            for digest, e in registry.remove_images(repo, doomed.keys()).items():
+                failed.update((t, e) for t in doomed[digest])
+        
+        if tags:
+            fake_ref = self._upload_fake_image(registry, repo)
+            if self._journal:
+                self._journal.fake_uploaded(repo, fake_ref)
+            
+            try:
+                # dont delete, just tag fake image with tags for deletion
+                failed.update(registry.tag_many(repo, self.fake_tag, tags))
+            finally:
+                # will remove _image_ referenced by tag, not just tag
+                # tags that failed are still pointing to original images so it is safe to continue
+                registry.remove_image(repo, fake_ref)
+            
+            if self._journal:
+                self._journal.fake_removed(repo)
+        
+        if failed:
+            raise Exception('Could not remove %d tags from %s: %s' % (len(failed), repo, ", ".join(failed.keys())))
     
     def clean_repository(self, registry, repo, pretend=False):
         cleaner = self.get_supported_cleaner(repo)
         
         if cleaner:
             tags = registry.get_tags(repo)
+            
+            if self.fake_tag in tags:
+                if pretend:
+                    tags = tuple(t for t in tags if t != self.fake_tag)
+                else:
+                    self._remove_fake_image(registry, repo)
+                    tags = registry.get_tags(repo)
+            
             self.logger.info("Using cleaner %r for repo %r", cleaner.name, repo)
             if tags:
                 tags_for_deletion = cleaner.select_tags(tags)
+                self.metrics.inc("tags_examined_total", len(tags), repository=repo)
+                self.metrics.inc("tags_selected_total", len(tags_for_deletion), repository=repo)
                 
                 if tags_for_deletion:
                     if pretend:
                         for i in tags_for_deletion:
                             self.logger.info("Would delete %s:%s", repo, i)
                     else:
-                        self.delete_tags(registry, repo, tags_for_deletion)
-                    return True
+                        self.delete_tags(registry, repo, tags_for_deletion, tags)
+                    return tags_for_deletion
             else:
                 self.logger.info("Found empty repo %s", repo)
         else:
             self.logger.info("Cleaner for %s not found", repo)
         
-        return False
+        return set()
+    
+    def _collect_results(self, futures, pending, failed, cleaned):
+        for f in futures:
+            repo = pending.pop(f)
+            e = f.exception()
+            if e is not None:
+                self.logger.error("Cleaning repo %s failed: %s", repo, e, exc_info=e)
+                self.metrics.inc("repositories_failed_total")
+                failed[repo] = e
+            else:
+                if self._journal:
+                    self._journal.done(repo)
+                if f.result():
+                    self.metrics.inc("repositories_cleaned_total")
+                    cleaned[repo] = f.result()
     
-    def clean(self, pretend=False):
+    def clean(self, pretend=False, jobs=1, repositories=None, deadline=None, journal=None):
+        """Cleans all supported repositories.
+        
+        Each repository is processed by a single worker so operations on it are kept in order,
+        up to ``jobs`` repositories are cleaned concurrently.
+        Failed repositories are reported with :class:`CleaningFailed` after all other ones are processed.
+        
+        When ``deadline`` passes no more repositories are taken from ``repositories`` iterator,
+        already started ones are finished and remaining ones are left in iterator.
+        
+        With ``journal`` each step is checkpointed: repositories finished by previous run are skipped
+        and fake images it left are removed first.
+        
+        :param pretend: Only log tags that would be removed.
+        :type pretend: bool
+        :param jobs: Number of repositories to clean concurrently.
+        :type jobs: int
+        :param repositories: Iterator of repositories to clean in given order, all repositories by default.
+        :type repositories: iterator
+        :param deadline: Value of :func:`time.monotonic` after which cleaning stops.
+        :type deadline: float
+        :param journal: Journal of current run.
+        :type journal: Journal
+        :raises: CleaningFailed
+        :returns: Tags selected for deletion in each repository.
+        :rtype: dict
+        """
+        with self.metrics.stage("untagging"):
+            return self._clean(pretend, jobs, repositories, deadline, journal)
+    
+    def _clean(self, pretend, jobs, repositories=None, deadline=None, journal=None):
+        jobs = max(1, jobs)
+        self._setup_registry(jobs)
+        
         if not self.registry.check():
             raise Exception('Could not connect to %s' % self.registry)
         
-        for repo in self.registry.get_repositories():
-            self.clean_repository(self.registry, repo, pretend)
+        failed = OrderedDict()
+        cleaned = OrderedDict()
+        pending = {}
+        self._fake_blob = None
+        self._journal = journal
+        self.listed_repositories = 0
+        
+        if journal:
+            for repo in journal.get_fake_images().keys():
+                self._remove_fake_image(self.registry, repo)
+                journal.fake_removed(repo)
+        
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            for repo in self.registry.iter_repositories() if repositories is None else repositories:
+                self.listed_repositories += 1
+                
+                if journal and journal.is_done(repo):
+                    continue
+                
+                pending[executor.submit(self.clean_repository, self.registry, repo, pretend)] = repo
+                
+                # keep only few queued repos so listing does not run far ahead of workers
+                if len(pending) >= jobs * 2:
+                    done, _not_done = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                    self._collect_results(done, pending, failed, cleaned)
+                
+                if deadline is not None and time.monotonic() >= deadline:
+                    self.logger.warning("Time budget exceeded, finishing %d started repositories", len(pending))
+                    break
+            
+            self._collect_results(concurrent.futures.as_completed(tuple(pending)), pending, failed, cleaned)
+        
+        if failed:
+            raise CleaningFailed(failed, cleaned)
+        
+        return cleaned
+    
+    def _setup_registry(self, jobs):
+        self.registry.set_workers(jobs)
     
     def list_repos(self):
         ret = {}
@@ -179,27 +394,215 @@ class Untagger(object):
     def close(self):
         self.registry.close()
 
+class StorageUntagger(Untagger):
+    """Untagger working directly on registry data dir, without running registry daemon.
+    
+    Tags are removed by deleting their links, untagged images are removed by garbage collector.
+    """
+    
+    def delete_tags(self, registry, repo, tags, all_tags=None):
+        registry.remove_tags(repo, tags)
+    
+    def _setup_registry(self, jobs):
+        pass
+    
+    def _remove_fake_image(self, registry, repo):
+        tagged = registry.get_tagged_manifests(repo)
+        fake_ref = tagged.get(self.fake_tag)
+        if fake_ref is not None:
+            self.logger.warning("Removing fake image left in %s", repo)
+            registry.remove_tags(repo, [t for t, d in tagged.items() if d == fake_ref])
+    
+    def close(self):
+        pass
+
 class Cleaner(object):
-    def __init__(self, untagger: Untagger, registry_storage: native.RegistryStorage, native_registry: native.NativeRegistry):
+    
+    gc_modes = ("registry", "native")
+    
+    def __init__(self, untagger: Untagger, storage_untagger: StorageUntagger, registry_storage: native.RegistryStorage, native_registry: native.NativeRegistry, garbage_collector: native.GarbageCollector, space_estimator: native.SpaceEstimator, metrics: Metrics):
         super(Cleaner, self).__init__()
         
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.metrics = metrics
         self._untagger = untagger
+        self._storage_untagger = storage_untagger
         self._storage = registry_storage
         self._native = native_registry
+        self._gc = garbage_collector
+        self._estimator = space_estimator
     
-    def clean(self, pretend=False):
-        with self._native.run():
-            self._untagger.clean(pretend)
+    def clean(self, pretend=False, jobs=1, offline=False, gc="registry", gc_index=None, uploads_max_age=None, time_budget=None, state_path=None, journal_path=None):
+        """Removes selected tags and then collects garbage.
+        
+        With ``gc="registry"`` garbage is collected twice by registry binary, before and after removing empty repositories.
+        With ``gc="native"`` single run of :class:`.native.GarbageCollector` does both,
+        optionally using persistent index stored at ``gc_index`` path.
+        
+        When ``uploads_max_age`` is set, upload sessions older than given number of seconds are purged
+        before collecting garbage.
+        
+        With ``time_budget`` repositories are untagged biggest-win-first, ordered by reclaimable space estimated
+        in a pass over registry data dir, and no more repositories are started after given number of seconds.
+        Budget is counted from the end of the estimation pass, so ordering does not use up time meant for untagging.
+        Garbage is still collected afterwards. Repositories left for next run are saved to ``state_path``
+        and are cleaned first by the next run using the same file.
+        
+        With ``journal_path`` untagging progress is checkpointed, so run restarted after crash skips finished repositories
+        and removes fake images left in registry. Journal is removed when all repositories were visited,
+        even when some of them failed, so next run examines every repository again.
+        
+        In pretend mode nothing is removed and space that would be reclaimed is estimated instead,
+        both for selected tags alone and for whole garbage collection run by :class:`.native.GarbageCollector`
+        in dry run mode, regardless of ``gc``.
+        
+        Repositories that could not be untagged do not stop other stages,
+        :class:`CleaningFailed` is raised after garbage is collected.
+        
+        :raises: CleaningFailed
+        :returns: Reclaimable space estimate when pretending.
+        :rtype: native.SpaceEstimate
+        """
+        if gc not in self.gc_modes:
+            raise Exception('Unknown garbage collector %r, available: %r' % (gc, self.gc_modes))
+        
+        schedule = None
+        repositories = None
+        deadline = None
+        if time_budget is not None:
+            schedule = self.get_schedule(jobs, self._load_state(state_path))
+            # estimating selects tags of every repository, on big registries it should not eat into untagging time
+            deadline = time.monotonic() + time_budget
+        elif state_path:
+            schedule = self.get_schedule(jobs, self._load_state(state_path), by_size=False)
+        if schedule is not None:
+            repositories = iter(schedule)
+        
+        untagger = self._storage_untagger if offline else self._untagger
+        
+        journal = Journal(journal_path) if journal_path and not pretend else None
+        failure = None
+        
+        try:
+            if offline:
+                selected = untagger.clean(pretend, jobs, repositories, deadline, journal)
+            else:
+                with self._native.run():
+                    selected = untagger.clean(pretend, jobs, repositories, deadline, journal)
+        except CleaningFailed as e:
+            # garbage left by cleaned repositories is still collected
+            failure = e
+            selected = e.cleaned
+        finally:
+            # repositories not taken by untagger are left in iterator
+            left = [] if repositories is None else list(repositories)
+            if state_path and not pretend:
+                self._save_state(state_path, left)
+            if journal:
+                journal.close()
+        
+        if journal and not left:
+            journal.remove()
+        
+        if pretend:
+            with self.metrics.stage("estimate"):
+                estimate = self._estimator.estimate(selected, jobs=jobs)
+            with self.metrics.stage("gc_dry_run"):
+                estimate.garbage_collect = self._gc.collect(jobs=jobs, index_path=gc_index, dry_run=True, removed_tags=selected)
+            if failure:
+                raise failure
+            return estimate
+        
+        if uploads_max_age is not None:
+            self._storage.purge_uploads(uploads_max_age, jobs=jobs)
+        
+        if gc == "native":
+            with self.metrics.stage("native_gc"):
+                result = self._gc.collect(jobs=jobs, index_path=gc_index)
+            self._record_gc_result(result)
+        else:
+            # repositories were already listed when untagging, walking storage again only for ETA would be slow
+            result = self._native.garbage_collect(repositories=len(schedule) if schedule is not None else untagger.listed_repositories)
+            self._record_gc_result(result)
+            removed = self._storage.remove_repositories_without_tags(jobs=jobs)
+            result = self._native.garbage_collect(repositories=result.scanned_repositories - removed)
+            self._record_gc_result(result)
+        
+        if failure:
+            raise failure
+    
+    def _estimate_repository(self, repo, references):
+        cleaner = self._storage_untagger.get_supported_cleaner(repo)
+        tags = self._storage.get_tags(repo)
+        if not cleaner or not tags:
+            return 0
+        return self._estimator.estimate_repository(repo, cleaner.select_tags(tags), references)
+    
+    def get_schedule(self, jobs=1, resumed=(), by_size=True):
+        """Returns repositories in order they should be cleaned.
+        
+        Repositories left by previous run come first, then other ones ordered by estimated reclaimable space.
+        
+        :param resumed: Repositories left by previous run.
+        :type resumed: iterable
+        :param by_size: Order repositories by reclaimable space, otherwise by name.
+        :type by_size: bool
+        :rtype: list
+        """
+        with self.metrics.stage("scheduling"):
+            names = self._storage.get_repositories()
+            
+            if by_size:
+                references = {}
+                with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+                    sizes = dict(zip(names, executor.map(lambda name: self._estimate_repository(name, references), names)))
+                names = sorted(names, key=lambda name: (-sizes[name], name))
             
-        if not pretend:
-            self._native.garbage_collect()
-            self._storage.remove_repositories_without_tags()
-            self._native.garbage_collect()
+            existing = set(names)
+            schedule = [name for name in resumed if name in existing]
+            started = set(schedule)
+            schedule.extend(name for name in names if name not in started)
+        
+        return schedule
+    
+    def _load_state(self, path):
+        if not path or not os.path.exists(path):
+            return ()
+        
+        with open(path, "rt") as f:
+            state = json.load(f)
+        
+        if state.get("version") != 1:
+            raise Exception("Unsupported state file version in %s" % path)
+        
+        self.logger.info("Resuming cleaning of %d repositories", len(state["pending"]))
+        return state["pending"]
+    
+    def _save_state(self, path, pending):
+        if not pending:
+            if os.path.exists(path):
+                os.unlink(path)
+            return
+        
+        self.logger.info("Saving %d repositories left for next run", len(pending))
+        tmp_path = "%s.tmp" % path
+        with open(tmp_path, "wt") as f:
+            json.dump({"version": 1, "pending": pending}, f)
+        os.replace(tmp_path, path)
+    
+    def _record_gc_result(self, result):
+        self.metrics.inc("blobs_deleted_total", result.deleted_blobs)
+        self.metrics.inc("manifests_deleted_total", result.deleted_manifests)
+        self.metrics.inc("repositories_removed_total", result.removed_repositories)
+        self.metrics.inc("freed_bytes_total", result.freed_bytes, source="gc")
     
     def close(self):
         self._native.cleanup()
         self._untagger.close()
     
-    def list_repos(self):
+    def list_repos(self, offline=False):
+        if offline:
+            return self._storage_untagger.list_repos()
+        
         with self._native.run():
             return self._untagger.list_repos()
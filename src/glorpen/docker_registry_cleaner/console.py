@@ -5,7 +5,7 @@
 import logging
 import argparse
 import pathlib
-from glorpen.docker_registry_cleaner.app import AppCompositor
+from glorpen.docker_registry_cleaner.app import AppCompositor, Cleaner
 from inspect import signature
 
 class Cli(object):
@@ -33,10 +33,21 @@ class Cli(object):
         sp = self.parser.add_subparsers()
         p = sp.add_parser('list-repos')
         p.set_defaults(f=self.list_repos)
+        p.add_argument("-o","--offline", action="store_true", help="Read registry data dir directly, without starting registry")
         
         p = sp.add_parser('clean')
         p.set_defaults(f=self.clean)
         p.add_argument("-p","--pretend", action="store_true")
+        p.add_argument("-j","--jobs", action="store", type=int, default=1, help="Number of repositories cleaned concurrently")
+        p.add_argument("-o","--offline", action="store_true", help="Remove tags directly from registry data dir, without starting registry")
+        p.add_argument("-g","--gc", action="store", choices=Cleaner.gc_modes, default="registry", help="Garbage collector to use")
+        p.add_argument("--gc-index", action="store", default=None, help="Path to index file used by native garbage collector to scan only changed repositories")
+        p.add_argument("--uploads-max-age", action="store", type=int, default=None, help="Remove upload sessions older than given number of hours")
+        p.add_argument("--time-budget", action="store", type=float, default=None, help="Stop untagging after given number of minutes counted after estimating repositories sizes, biggest repositories are cleaned first")
+        p.add_argument("--state-file", action="store", default=None, help="Path to file with repositories left for next run")
+        p.add_argument("--journal", action="store", default=None, help="Path to checkpoint journal used to resume interrupted run")
+        p.add_argument("--metrics-json", action="store", default=None, help="Path to save JSON report with stage timings and counters to")
+        p.add_argument("--metrics-prometheus", action="store", default=None, help="Path to save metrics for Prometheus textfile collector to")
     
     def set_verbosity(self, local_level):
         """Sets log levels, available are: 0:WARNING, 1:INFO, 2:DEBUG"""
@@ -66,15 +77,50 @@ class Cli(object):
             
             args[k] = v
         
-        ns.f(**args)
+        try:
+            ns.f(**args)
+        finally:
+            # saves persistent manifest cache and releases connections
+            app.close()
         
-    def clean(self, app, pretend):
+    def clean(self, app, pretend, jobs, offline, gc, gc_index, uploads_max_age, time_budget, state_file, journal, metrics_json, metrics_prometheus):
         """Run cleanup tasks."""
-        app.clean(pretend=pretend)
+        if uploads_max_age is not None:
+            uploads_max_age = uploads_max_age * 3600
+        if time_budget is not None:
+            time_budget = time_budget * 60
+        
+        try:
+            estimate = app.clean(
+                pretend=pretend, jobs=jobs, offline=offline, gc=gc, gc_index=gc_index, uploads_max_age=uploads_max_age,
+                time_budget=time_budget, state_path=state_file, journal_path=journal
+            )
+        finally:
+            # metrics of failed run are saved too, to show which stage failed
+            if metrics_json:
+                app.metrics.write_json(metrics_json)
+            if metrics_prometheus:
+                app.metrics.write_prometheus(metrics_prometheus)
+        
+        if estimate:
+            for repo, size in estimate.repositories.items():
+                print("%s: %d bytes reclaimable" % (repo, size))
+            if estimate.shared_bytes:
+                print("Shared between repositories: %d bytes reclaimable" % estimate.shared_bytes)
+            print("Total: %d bytes reclaimable in %d blobs" % (estimate.total_bytes, estimate.blobs))
+            
+            gc_result = estimate.garbage_collect
+            if gc_result:
+                print("Garbage collection: %d bytes reclaimable in %d blobs, %d manifests and %d repositories would be removed" % (
+                    gc_result.freed_bytes, gc_result.deleted_blobs, gc_result.deleted_manifests, gc_result.removed_repositories
+                ))
+                print("Left by previous runs: %d bytes reclaimable in %d blobs" % (
+                    gc_result.freed_bytes - estimate.total_bytes, gc_result.deleted_blobs - estimate.blobs
+                ))
     
-    def list_repos(self, app):
+    def list_repos(self, app, offline):
         """Prints repositories."""
-        for repo, images in app.list_repos().items():
+        for repo, images in app.list_repos(offline=offline).items():
             for tag in images:
                 print("%s:%s" % (repo, tag))
             if not images:
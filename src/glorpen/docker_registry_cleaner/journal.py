@@ -0,0 +1,103 @@
+'''
+.. moduleauthor:: Arkadiusz Dzięgiel <arkadiusz.dziegiel@glorpen.pl>
+'''
+import json
+import logging
+import os
+import threading
+
+class Journal(object):
+    """Checkpoint journal of cleaning run, stored as JSON lines.
+    
+    Each step is appended and synced to disk before next one is started, so after crashed run
+    cleaning can skip finished repositories and remove fake images left in registry.
+    Tags moved to fake image are not recorded, as removing the image removes them too.
+    Last line can be incomplete when process was killed while writing it and is ignored.
+    """
+    
+    def __init__(self, path):
+        """
+        :param path: Path to journal file, created when missing.
+        :type path: str
+        """
+        super(Journal, self).__init__()
+        
+        self.path = path
+        self.logger = logging.getLogger(self.__class__.__name__)
+        
+        self._lock = threading.Lock()
+        self._done = set()
+        self._fake_images = {}
+        
+        self._incomplete = False
+        self._load()
+        self._file = open(self.path, "at")
+        
+        if self._incomplete:
+            # next entry should not be appended to partially written one
+            self._file.write("\n")
+    
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        
+        with open(self.path, "rt") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    self.logger.warning("Ignoring incomplete journal entry: %r", line)
+                    self._incomplete = not line.endswith("\n")
+                    continue
+                self._apply(entry)
+        
+        self.logger.info("Loaded journal with %d finished repositories and %d fake images left", len(self._done), len(self._fake_images))
+    
+    def _apply(self, entry):
+        event = entry["event"]
+        repo = entry["repository"]
+        
+        if event == "fake_uploaded":
+            self._fake_images[repo] = entry["digest"]
+        elif event == "fake_removed":
+            self._fake_images.pop(repo, None)
+        elif event == "done":
+            self._done.add(repo)
+        else:
+            raise Exception("Unknown journal event %r" % event)
+    
+    def _write(self, entry):
+        with self._lock:
+            self._apply(entry)
+            self._file.write(json.dumps(entry) + "\n")
+            self._file.flush()
+            os.fsync(self._file.fileno())
+    
+    def fake_uploaded(self, repository, digest):
+        self._write({"event": "fake_uploaded", "repository": repository, "digest": digest})
+    
+    def fake_removed(self, repository):
+        self._write({"event": "fake_removed", "repository": repository})
+    
+    def done(self, repository):
+        self._write({"event": "done", "repository": repository})
+    
+    def is_done(self, repository):
+        with self._lock:
+            return repository in self._done
+    
+    def get_fake_images(self):
+        """Returns digests of fake images not removed yet, keyed by repository name.
+        
+        :rtype: dict
+        """
+        with self._lock:
+            return dict(self._fake_images)
+    
+    def close(self):
+        self._file.close()
+    
+    def remove(self):
+        """Closes and removes journal of finished run."""
+        self.close()
+        os.unlink(self.path)
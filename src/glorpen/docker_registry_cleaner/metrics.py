@@ -0,0 +1,189 @@
+'''
+.. moduleauthor:: Arkadiusz Dzięgiel <arkadiusz.dziegiel@glorpen.pl>
+'''
+import contextlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+class Histogram(object):
+    """Cumulative histogram with fixed buckets, as used by Prometheus."""
+    
+    def __init__(self, buckets):
+        super(Histogram, self).__init__()
+        
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+    
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, le in enumerate(self.buckets):
+            if value <= le:
+                self.counts[i] += 1
+
+class Metrics(object):
+    """Collects timings and counters of single run.
+    
+    Stages are timed with :meth:`.stage`, counters and histograms are identified by name and labels.
+    Collected values can be saved as JSON report or as Prometheus textfile collector file.
+    """
+    
+    prefix = "registry_cleaner"
+    """Prefix of Prometheus metrics names."""
+    
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+    """Upper bounds of histogram buckets, in seconds."""
+    
+    descriptions = {
+        "stage_seconds": "Wall time spent in cleaning stage.",
+        "stage_runs": "Number of times cleaning stage was run.",
+        "http_requests_total": "Registry API requests by endpoint, method and response status.",
+        "http_request_duration_seconds": "Registry API request latency by endpoint and method.",
+        "tags_examined_total": "Tags examined by selectors.",
+        "tags_selected_total": "Tags selected for deletion.",
+        "repositories_cleaned_total": "Repositories with tags selected for deletion.",
+        "repositories_failed_total": "Repositories that could not be cleaned.",
+        "repositories_removed_total": "Repositories without tags removed from registry data dir.",
+        "uploads_removed_total": "Stale upload sessions removed.",
+        "blobs_deleted_total": "Blobs deleted by garbage collector.",
+        "manifests_deleted_total": "Untagged manifests deleted by garbage collector.",
+        "freed_bytes_total": "Bytes freed by removing data.",
+    }
+    
+    def __init__(self):
+        super(Metrics, self).__init__()
+        
+        self._lock = threading.Lock()
+        self._stages = OrderedDict()
+        self._counters = OrderedDict()
+        self._histograms = OrderedDict()
+    
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Measures wall time of wrapped block, times of repeated stages are summed."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                seconds, runs = self._stages.get(name, (0.0, 0))
+                self._stages[name] = (seconds + elapsed, runs + 1)
+    
+    def _key(self, name, labels):
+        return name, tuple(sorted(labels.items()))
+    
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+    
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            if key not in self._histograms:
+                self._histograms[key] = Histogram(self.buckets)
+            self._histograms[key].observe(value)
+    
+    def get_stage_time(self, name):
+        with self._lock:
+            return self._stages.get(name, (0.0, 0))[0]
+    
+    def get_counter(self, name, **labels):
+        """Returns counter value, when labels are not given values for all labels are summed."""
+        with self._lock:
+            if labels:
+                return self._counters.get(self._key(name, labels), 0)
+            return sum(v for (n, _labels), v in self._counters.items() if n == name)
+    
+    def get_report(self):
+        """Returns collected metrics as JSON serializable dict.
+        
+        :rtype: OrderedDict
+        """
+        report = OrderedDict([("stages", OrderedDict()), ("counters", OrderedDict()), ("histograms", OrderedDict())])
+        
+        with self._lock:
+            for name, (seconds, runs) in self._stages.items():
+                report["stages"][name] = OrderedDict([("seconds", seconds), ("runs", runs)])
+            
+            for (name, labels), value in self._counters.items():
+                report["counters"].setdefault(name, []).append(OrderedDict([("labels", OrderedDict(labels)), ("value", value)]))
+            
+            for (name, labels), h in self._histograms.items():
+                report["histograms"].setdefault(name, []).append(OrderedDict([
+                    ("labels", OrderedDict(labels)),
+                    ("count", h.count),
+                    ("sum", h.sum),
+                    ("buckets", OrderedDict(zip(("%g" % le for le in h.buckets), h.counts))),
+                ]))
+        
+        return report
+    
+    def _format_labels(self, labels):
+        if not labels:
+            return ""
+        escaped = (
+            (k, str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"'))
+            for k, v in labels
+        )
+        return "{%s}" % ",".join('%s="%s"' % i for i in escaped)
+    
+    def _describe(self, lines, name, metric_type):
+        metric = "%s_%s" % (self.prefix, name)
+        if name in self.descriptions:
+            lines.append("# HELP %s %s" % (metric, self.descriptions[name]))
+        lines.append("# TYPE %s %s" % (metric, metric_type))
+        return metric
+    
+    def get_prometheus_text(self):
+        """Returns collected metrics in Prometheus text exposition format."""
+        lines = []
+        
+        with self._lock:
+            for name, index in (("stage_seconds", 0), ("stage_runs", 1)):
+                if self._stages:
+                    metric = self._describe(lines, name, "gauge")
+                for stage, values in self._stages.items():
+                    lines.append('%s{stage="%s"} %s' % (metric, stage, repr(values[index])))
+            
+            # samples of each metric have to be grouped
+            described = set()
+            for (name, labels), value in sorted(self._counters.items(), key=lambda i: i[0][0]):
+                if name not in described:
+                    self._describe(lines, name, "counter")
+                    described.add(name)
+                lines.append("%s_%s%s %s" % (self.prefix, name, self._format_labels(labels), repr(value)))
+            
+            for (name, labels), h in sorted(self._histograms.items(), key=lambda i: i[0][0]):
+                metric = "%s_%s" % (self.prefix, name)
+                if name not in described:
+                    self._describe(lines, name, "histogram")
+                    described.add(name)
+                for le, count in zip(h.buckets, h.counts):
+                    lines.append("%s_bucket%s %d" % (metric, self._format_labels(labels + (("le", "%g" % le),)), count))
+                lines.append("%s_bucket%s %d" % (metric, self._format_labels(labels + (("le", "+Inf"),)), h.count))
+                lines.append("%s_sum%s %s" % (metric, self._format_labels(labels), repr(h.sum)))
+                lines.append("%s_count%s %d" % (metric, self._format_labels(labels), h.count))
+        
+        return "\n".join(lines) + "\n"
+    
+    def _write(self, path, text):
+        # textfile collector could read partially written file, so it is replaced at once
+        tmp_path = "%s.tmp" % path
+        with open(tmp_path, "wt") as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+    
+    def write_json(self, path):
+        """Saves JSON report to given path."""
+        self._write(path, json.dumps(self.get_report(), indent=2))
+    
+    def write_prometheus(self, path):
+        """Saves metrics to file read by Prometheus node exporter textfile collector."""
+        self._write(path, self.get_prometheus_text())
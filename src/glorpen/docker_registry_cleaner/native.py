@@ -11,8 +11,15 @@ import yaml
 import pkg_resources
 import contextlib
 import threading
-import glob
-import pathlib
+import json
+import sqlite3
+import tempfile
+import concurrent.futures
+import datetime
+import re
+import time
+from collections import OrderedDict
+from glorpen.docker_registry_cleaner.metrics import Metrics
 
 class NativeRegistry(object):
     """Allows executing registry commands using real registry binary.
@@ -25,7 +32,7 @@ class NativeRegistry(object):
     
     _registry_proc = None
     
-    def __init__(self, registry_data, registry_bin, registry_address):
+    def __init__(self, registry_data, registry_bin, registry_address, metrics=None):
         """
         :param registry_data: Path to registry datadir.
         :type registry_data: str
@@ -33,12 +40,15 @@ class NativeRegistry(object):
         :type registry_bin: str
         :param registry_address: Address that registry should listen on.
         :type registry_address: str
+        :param metrics: Collector of stage timings.
+        :type metrics: Metrics
         """
         super(NativeRegistry, self).__init__()
         
         self.registry_data = registry_data
         self.registry_address = registry_address
         self.registry_bin = registry_bin
+        self.metrics = Metrics() if metrics is None else metrics
         
         self.logger = logging.getLogger(self.__class__.__name__)
         self.registry_logger = logging.getLogger("%s:registry" % self.__class__.__name__)
@@ -61,19 +71,33 @@ class NativeRegistry(object):
         if os.path.exists(self._config_path):
             os.unlink(self._config_path)
     
-    def garbage_collect(self):
+    def garbage_collect(self, repositories=None, progress_interval=10):
         """Starts registry binary in garbage-collect mode and waits for completion.
         
+        Output of registry is parsed while it runs and progress is logged every ``progress_interval`` seconds.
         Will throw an Exception when failed.
         
+        :param repositories: Number of repositories in registry, if known, used to estimate remaining time of marking.
+        :type repositories: int
+        :param progress_interval: Seconds between progress reports.
+        :type progress_interval: float
         :raises: Exception
+        :rtype: GarbageCollectResult
         """
         self.logger.info("Running garbage collector")
-        p = subprocess.Popen([self.registry_bin, "garbage-collect", self._save_config(), "--delete-untagged=true"], stderr=subprocess.PIPE, stdout=subprocess.PIPE)
-        retval = self._track_process(p, wait=True)
+        progress = GarbageCollectProgress(repositories, progress_interval)
+        
+        with self.metrics.stage("registry_gc"):
+            p = subprocess.Popen([self.registry_bin, "garbage-collect", self._save_config(), "--delete-untagged=true"], stderr=subprocess.PIPE, stdout=subprocess.PIPE)
+            retval = self._track_process(p, progress.feed, wait=True)
         
         if retval != 0:
             raise Exception("registry garbage-collect failed")
+        
+        result = progress.get_result()
+        self.logger.info("Garbage collection finished: %r", result)
+        
+        return result
     
     def _track_process(self, p, cb=None, wait=True):
         
@@ -89,11 +113,19 @@ class NativeRegistry(object):
                 self.registry_logger.debug(line)
             fd.close()
         
-        threading.Thread(target=_read, kwargs={"fd": p.stderr}, daemon=True).start()
-        threading.Thread(target=_read, kwargs={"fd": p.stdout}, daemon=True).start()
+        threads = [
+            threading.Thread(target=_read, kwargs={"fd": p.stderr}, daemon=True),
+            threading.Thread(target=_read, kwargs={"fd": p.stdout}, daemon=True),
+        ]
+        for t in threads:
+            t.start()
         
         if wait:
-            return p.wait()
+            retval = p.wait()
+            # process output could be not fully read yet
+            for t in threads:
+                t.join()
+            return retval
     
     def start(self):
         """Starts registry daemon and blocks until it is initialized."""
@@ -110,10 +142,11 @@ class NativeRegistry(object):
                 
                 return True
         
-        c.acquire()
-        self._track_process(self._registry_proc, daemon_semaphore, wait=False)
-        
-        c.wait()
+        with self.metrics.stage("registry_start"):
+            c.acquire()
+            self._track_process(self._registry_proc, daemon_semaphore, wait=False)
+            
+            c.wait()
         
     def stop(self):
         """Stop running processes, does not clean temporary data."""
@@ -133,26 +166,338 @@ class NativeRegistry(object):
 class RegistryStorage(object):
     """Manages raw registry files."""
     
-    def __init__(self, registry_path, api_version="v2"):
+    def __init__(self, registry_path, api_version="v2", metrics=None):
         """
         :param registry_path: Path to registry datadir.
         :type registry_path: str
+        :param metrics: Collector of stage timings and removed data counters.
+        :type metrics: Metrics
         """
         super(RegistryStorage, self).__init__()
         
         self._api_version = api_version
         self._reg_path = registry_path
+        self._metrics = Metrics() if metrics is None else metrics
         
         self._logger = logging.getLogger(self.__class__.__name__)
     
-    def remove_repositories_without_tags(self):
-        """Checks repositories in registry data dir and removes ones without tags.""" 
-        repos_path = self._get_repositories_path()
-        for p in glob.glob('%s/**/_manifests/tags' % repos_path, recursive=True):
-            r = str(pathlib.Path(p).relative_to(repos_path).parent.parent)
-            if not self.has_tags(r):
-                self._logger.info("Removing data for repository %s", r)
-                self.remove_repository(r)
+    @property
+    def registry_path(self):
+        """Path to registry datadir."""
+        return self._reg_path
+    
+    def remove_repositories_without_tags(self, jobs=1):
+        """Checks repositories in registry data dir and removes ones without tags.
+        
+        Repositories are removed as soon as they are found, while the rest of data dir is still scanned.
+        
+        :param jobs: Number of directories scanned concurrently.
+        :type jobs: int
+        :return: Number of removed repositories.
+        """
+        removed = 0
+        with self._metrics.stage("sweep"):
+            for r, empty in self._walk_repositories(jobs, self._is_without_tags):
+                if empty:
+                    self._logger.info("Removing data for repository %s", r)
+                    self.remove_repository(r)
+                    removed += 1
+        
+        self._metrics.inc("repositories_removed_total", removed)
+        return removed
+    
+    def _is_without_tags(self, repository):
+        try:
+            return not self.has_tags(repository)
+        except FileNotFoundError:
+            # repository without tags dir was never tagged, leave it to registry
+            return False
+    
+    def check(self):
+        """Checks whether registry data dir contains repositories."""
+        return os.path.isdir(self._get_repositories_path())
+    
+    def _scan_directory(self, path, inspect=None):
+        is_repository = False
+        subdirs = []
+        for entry in os.scandir(path):
+            if entry.name == "_manifests":
+                is_repository = True
+            # internal registry dirs are prefixed with underscore, repository names cannot be
+            elif not entry.name.startswith("_") and entry.is_dir():
+                subdirs.append(entry.name)
+        
+        name = os.path.relpath(path, self._get_repositories_path())
+        info = inspect(name) if is_repository and inspect else None
+        
+        return name, is_repository, info, ["%s/%s" % (path, d) for d in sorted(subdirs)]
+    
+    def _walk_repositories(self, jobs=1, inspect=None):
+        """Yields repository names with result of ``inspect`` called on each one.
+        
+        Scanning stops at registry internal directories (``_manifests``, ``_layers``, ``_uploads``).
+        With more than one job directories are scanned concurrently and repositories are yielded in no particular order.
+        """
+        if not self.check():
+            return
+        
+        if jobs <= 1:
+            stack = [self._get_repositories_path()]
+            while stack:
+                name, is_repository, info, subdirs = self._scan_directory(stack.pop(), inspect)
+                if is_repository:
+                    yield name, info
+                stack.extend(reversed(subdirs))
+            return
+        
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            pending = {executor.submit(self._scan_directory, self._get_repositories_path(), inspect)}
+            try:
+                while pending:
+                    done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for f in done:
+                        name, is_repository, info, subdirs = f.result()
+                        pending.update(executor.submit(self._scan_directory, d, inspect) for d in subdirs)
+                        if is_repository:
+                            yield name, info
+            finally:
+                for f in pending:
+                    f.cancel()
+    
+    def iter_repositories(self, jobs=1):
+        """Iterates over repositories names found in registry data dir.
+        
+        :param jobs: Number of directories scanned concurrently, names are sorted only when scanning sequentially.
+        :type jobs: int
+        """
+        for name, _info in self._walk_repositories(jobs):
+            yield name
+    
+    def get_repositories(self):
+        """List repositories names."""
+        return tuple(self.iter_repositories())
+    
+    def get_tags(self, repository):
+        """List tag names for given repository."""
+        try:
+            return tuple(sorted(os.listdir(self._get_tags_path(repository))))
+        except FileNotFoundError:
+            return tuple()
+    
+    def remove_tags(self, repository, tags):
+        """Removes tags from given repository.
+        
+        Only tag links are removed, images left without tags should be removed by garbage collector.
+        
+        :param repository: Repository name.
+        :type repository: str
+        :param tags: Tag names.
+        :type tags: iterable
+        """
+        tags_path = self._get_tags_path(repository)
+        for tag in tags:
+            self._logger.info("Removing tag %s:%s", repository, tag)
+            shutil.rmtree("%s/%s" % (tags_path, tag))
+    
+    def _read_link(self, path):
+        try:
+            with open(path, "rt") as f:
+                return f.read().strip()
+        except FileNotFoundError:
+            return None
+    
+    def get_tagged_manifests(self, repository):
+        """Returns digests of manifests currently referenced by tags in given repository.
+        
+        :param repository: Repository name.
+        :type repository: str
+        :rtype: dict
+        """
+        tags_path = self._get_tags_path(repository)
+        ret = {}
+        for tag in self.get_tags(repository):
+            digest = self._read_link("%s/%s/current/link" % (tags_path, tag))
+            if digest:
+                ret[tag] = digest
+        return ret
+    
+    def get_manifest_revisions(self, repository):
+        """Returns digests of all manifests stored in given repository."""
+        revisions_path = self._get_revisions_path(repository)
+        ret = set()
+        try:
+            algorithms = os.listdir(revisions_path)
+        except FileNotFoundError:
+            return ret
+        
+        for algorithm in algorithms:
+            for hex_digest in os.listdir("%s/%s" % (revisions_path, algorithm)):
+                ret.add("%s:%s" % (algorithm, hex_digest))
+        return ret
+    
+    def _get_stamp(self, path):
+        """Returns value changed whenever entries are added to or removed from given directory, ``None`` when it is missing."""
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        # links count catches subdirectories added within modification time resolution, on filesystems counting them
+        return "%d:%d:%d" % (st.st_ino, st.st_mtime_ns, st.st_nlink)
+    
+    def get_repository_fingerprint(self, repository):
+        """Returns value which changes whenever tags or manifests are added to or removed from given repository.
+        
+        Only tags and revisions directories are checked, so cost does not depend on number of tags.
+        Moving existing tag to other manifest already stored in repository is not detected,
+        but garbage collector removes untagged manifests so such manifest is already marked.
+        """
+        revisions_path = self._get_revisions_path(repository)
+        paths = [self._get_tags_path(repository), revisions_path]
+        try:
+            paths.extend("%s/%s" % (revisions_path, i) for i in sorted(os.listdir(revisions_path)))
+        except FileNotFoundError:
+            pass
+        
+        return "|".join(self._get_stamp(p) or "-" for p in paths)
+    
+    def read_manifest(self, digest):
+        """Returns parsed manifest stored under given digest or ``None`` when it is missing or is not a manifest."""
+        try:
+            with open(self._get_blob_path(digest), "rb") as f:
+                return json.loads(f.read().decode())
+        except (FileNotFoundError, ValueError):
+            return None
+    
+    def get_manifest_references(self, digest):
+        """Returns blobs and child manifests referenced by given manifest.
+        
+        Supports image manifests, manifest lists and schema1 manifests.
+        
+        :returns: Tuple of blob digests and child manifest digests.
+        :rtype: tuple
+        """
+        manifest = self.read_manifest(digest)
+        if not isinstance(manifest, dict):
+            return (), ()
+        
+        if "manifests" in manifest:
+            return (), tuple(i["digest"] for i in manifest["manifests"])
+        
+        if "fsLayers" in manifest:
+            return tuple(i["blobSum"] for i in manifest["fsLayers"]), ()
+        
+        blobs = [i["digest"] for i in manifest.get("layers", ())]
+        if "config" in manifest:
+            blobs.append(manifest["config"]["digest"])
+        return tuple(blobs), ()
+    
+    def get_reachable(self, manifests, references=None):
+        """Returns blobs reachable from given manifests, including manifests themselves and their children.
+        
+        :param manifests: Manifest digests.
+        :type manifests: iterable
+        :param references: Optional dict used to cache references of visited manifests,
+                           manifests are immutable so it can be shared between repositories.
+        :type references: dict
+        :returns: Tuple of reachable blob digests and reachable manifest digests.
+        :rtype: tuple
+        """
+        if references is None:
+            references = {}
+        
+        blobs = set()
+        queue = list(manifests)
+        seen = set()
+        
+        while queue:
+            digest = queue.pop()
+            if digest in seen:
+                continue
+            seen.add(digest)
+            blobs.add(digest)
+            
+            if digest not in references:
+                references[digest] = self.get_manifest_references(digest)
+            
+            layers, children = references[digest]
+            blobs.update(layers)
+            queue.extend(children)
+        
+        return blobs, seen
+    
+    def iter_blobs(self):
+        """Iterates over digests of all blobs in registry data dir."""
+        blobs_path = self._get_blobs_path()
+        try:
+            algorithms = os.listdir(blobs_path)
+        except FileNotFoundError:
+            return
+        
+        for algorithm in algorithms:
+            for prefix in os.listdir("%s/%s" % (blobs_path, algorithm)):
+                for hex_digest in os.listdir("%s/%s/%s" % (blobs_path, algorithm, prefix)):
+                    yield "%s:%s" % (algorithm, hex_digest)
+    
+    def get_blob_prefixes(self):
+        """Returns stamps of directories grouping blobs by digest prefix, keyed by their path relative to blobs dir.
+        
+        Stamp changes whenever blob is added to or removed from directory.
+        
+        :rtype: dict
+        """
+        blobs_path = self._get_blobs_path()
+        ret = {}
+        try:
+            algorithms = os.listdir(blobs_path)
+        except FileNotFoundError:
+            return ret
+        
+        for algorithm in algorithms:
+            for prefix in os.listdir("%s/%s" % (blobs_path, algorithm)):
+                path = "%s/%s" % (algorithm, prefix)
+                ret[path] = self._get_stamp("%s/%s" % (blobs_path, path))
+        return ret
+    
+    def get_blob_prefix(self, digest):
+        """Returns path of directory containing given blob, relative to blobs dir."""
+        algorithm, hex_digest = digest.split(":", 1)
+        return "%s/%s" % (algorithm, hex_digest[0:2])
+    
+    def get_prefix_stamp(self, prefix):
+        return self._get_stamp("%s/%s" % (self._get_blobs_path(), prefix))
+    
+    def iter_prefix_blobs(self, prefix):
+        """Iterates over digests of blobs in directory returned by :meth:`.get_blob_prefixes`."""
+        algorithm = prefix.split("/", 1)[0]
+        for hex_digest in os.listdir("%s/%s" % (self._get_blobs_path(), prefix)):
+            yield "%s:%s" % (algorithm, hex_digest)
+    
+    def get_blob_size(self, digest):
+        """Returns size of blob data in bytes, zero when it is missing."""
+        try:
+            return os.stat(self._get_blob_path(digest)).st_size
+        except FileNotFoundError:
+            return 0
+    
+    def remove_blob(self, digest):
+        """Deletes blob data, it should not be referenced by any manifest."""
+        shutil.rmtree(os.path.dirname(self._get_blob_path(digest)))
+    
+    def remove_manifest(self, repository, digest):
+        """Deletes manifest revision and its tag index entries from given repository."""
+        algorithm, hex_digest = digest.split(":", 1)
+        shutil.rmtree("%s/%s/%s" % (self._get_revisions_path(repository), algorithm, hex_digest), ignore_errors=True)
+        
+        tags_path = self._get_tags_path(repository)
+        for tag in self.get_tags(repository):
+            shutil.rmtree("%s/%s/index/%s/%s" % (tags_path, tag, algorithm, hex_digest), ignore_errors=True)
+    
+    def _get_blobs_path(self):
+        return "%s/docker/registry/%s/blobs" % (self._reg_path, self._api_version)
+    
+    def _get_blob_path(self, digest):
+        algorithm, hex_digest = digest.split(":", 1)
+        return "%s/%s/%s/%s/data" % (self._get_blobs_path(), algorithm, hex_digest[0:2], hex_digest)
     
     def _get_repositories_path(self):
         return "%s/docker/registry/%s/repositories" % (self._reg_path, self._api_version)
@@ -163,6 +508,92 @@ class RegistryStorage(object):
     def _get_tags_path(self, repository):
         return self._get_repository_path(repository) + "/_manifests/tags"
     
+    def _get_revisions_path(self, repository):
+        return self._get_repository_path(repository) + "/_manifests/revisions"
+    
+    def _get_uploads_path(self, repository):
+        return self._get_repository_path(repository) + "/_uploads"
+    
+    def get_upload_started_at(self, repository, upload):
+        """Returns timestamp of upload session start.
+        
+        Time is read from ``startedat`` file written by registry, modification time of upload dir is used when it is missing.
+        
+        :param repository: Repository name.
+        :type repository: str
+        :param upload: Upload session id.
+        :type upload: str
+        :rtype: float
+        """
+        upload_path = "%s/%s" % (self._get_uploads_path(repository), upload)
+        started_at = self._read_link(upload_path + "/startedat")
+        if started_at:
+            try:
+                return datetime.datetime.strptime(started_at, "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=datetime.timezone.utc).timestamp()
+            except ValueError:
+                self._logger.debug("Unsupported start time %r for upload %s@%s", started_at, repository, upload)
+        
+        return os.stat(upload_path).st_mtime
+    
+    def _get_path_size(self, path):
+        size = 0
+        for dirpath, _dirnames, filenames in os.walk(path):
+            for f in filenames:
+                size += os.lstat("%s/%s" % (dirpath, f)).st_size
+        return size
+    
+    def get_stale_uploads(self, repository, started_before):
+        """Finds upload sessions started before given time.
+        
+        :param repository: Repository name.
+        :type repository: str
+        :param started_before: Timestamp.
+        :type started_before: float
+        :return: List of upload ids with size of their data.
+        """
+        uploads_path = self._get_uploads_path(repository)
+        try:
+            uploads = sorted(os.listdir(uploads_path))
+        except FileNotFoundError:
+            return []
+        
+        return [
+            (upload, self._get_path_size("%s/%s" % (uploads_path, upload)))
+            for upload in uploads
+            if self.get_upload_started_at(repository, upload) < started_before
+        ]
+    
+    def remove_upload(self, repository, upload):
+        shutil.rmtree("%s/%s" % (self._get_uploads_path(repository), upload))
+    
+    def purge_uploads(self, max_age, jobs=1):
+        """Removes upload sessions older than given age, left by interrupted pushes.
+        
+        Registry should not be running, as in-progress uploads would be removed too.
+        
+        :param max_age: Age in seconds.
+        :type max_age: int
+        :param jobs: Number of directories scanned concurrently.
+        :type jobs: int
+        :rtype: UploadsPurgeResult
+        """
+        started_before = datetime.datetime.now(datetime.timezone.utc).timestamp() - max_age
+        result = UploadsPurgeResult()
+        
+        with self._metrics.stage("uploads_purge"):
+            for repository, uploads in self._walk_repositories(jobs, lambda r: self.get_stale_uploads(r, started_before)):
+                for upload, size in uploads:
+                    self._logger.info("Removing stale upload %s@%s", repository, upload)
+                    self.remove_upload(repository, upload)
+                    result.removed_uploads += 1
+                    result.freed_bytes += size
+        
+        self._metrics.inc("uploads_removed_total", result.removed_uploads)
+        self._metrics.inc("freed_bytes_total", result.freed_bytes, source="uploads")
+        self._logger.info("Uploads purge finished: %r", result)
+        
+        return result
+    
     def has_tags(self, repository):
         """Checks if tags directory for given repository is not empty.
         
@@ -180,8 +611,602 @@ class RegistryStorage(object):
         
             there is no rollback, your data will be gone
         
+        Nested repositories are preserved.
+        
+        :param name: Repository name.
+        :type name: str
+        
+        """
+        repository_path = self._get_repository_path(name)
+        nested = False
+        for entry in os.listdir(repository_path):
+            if entry.startswith("_"):
+                shutil.rmtree("%s/%s" % (repository_path, entry))
+            else:
+                nested = True
+        
+        if not nested:
+            os.rmdir(repository_path)
+
+
+class GarbageCollectResult(object):
+    """Statistics of single garbage collector run."""
+    
+    def __init__(self):
+        super(GarbageCollectResult, self).__init__()
+        
+        self.marked_manifests = 0
+        """Manifests referenced by tags, reported only by registry binary."""
+        self.marked_blobs = 0
+        self.eligible_manifests = 0
+        self.eligible_blobs = 0
+        self.deleted_blobs = 0
+        self.deleted_manifests = 0
+        self.scanned_repositories = 0
+        self.removed_repositories = 0
+        self.unchanged_repositories = 0
+        self.freed_bytes = 0
+    
+    def __repr__(self):
+        return "<%s marked_manifests=%d marked_blobs=%d eligible_manifests=%d eligible_blobs=%d deleted_blobs=%d deleted_manifests=%d scanned_repositories=%d removed_repositories=%d unchanged_repositories=%d freed_bytes=%d>" % (
+            self.__class__.__name__, self.marked_manifests, self.marked_blobs, self.eligible_manifests, self.eligible_blobs,
+            self.deleted_blobs, self.deleted_manifests, self.scanned_repositories, self.removed_repositories,
+            self.unchanged_repositories, self.freed_bytes
+        )
+
+class GarbageCollectProgress(object):
+    """Tracks progress of ``registry garbage-collect`` by parsing its output line by line.
+    
+    Registry prints name of each marked repository and marked manifests and blobs,
+    then removes untagged manifests, prints summary and removes blobs.
+    Remaining time is estimated from rate of marked repositories, when total number is known,
+    and from rate of removed blobs after summary is printed.
+    Registry does not report sizes of removed blobs, so freed bytes are not counted.
+    """
+    
+    _re_marking = re.compile(r'^(\S+): marking (manifest|blob) (\S+)')
+    _re_eligible_manifest = re.compile(r'^manifest eligible for deletion: (\S+)')
+    _re_summary = re.compile(r'^(\d+) blobs marked, (\d+) blobs and (\d+) manifests eligible for deletion')
+    _re_deleting = re.compile(r'msg="(deleting blob|deleting manifest): ', re.I)
+    _re_repository = re.compile(r'^[a-z0-9]+(?:[._/-][a-z0-9]+)*$')
+    
+    def __init__(self, repositories=None, interval=10, clock=time.monotonic):
+        """
+        :param repositories: Total number of repositories, if known.
+        :type repositories: int
+        :param interval: Seconds between progress reports.
+        :type interval: float
+        """
+        super(GarbageCollectProgress, self).__init__()
+        
+        self.repositories = repositories
+        self.interval = interval
+        
+        self.phase = "mark"
+        self.scanned_repositories = 0
+        self.marked_manifests = 0
+        self.marked_blobs = 0
+        self.eligible_manifests = 0
+        self.eligible_blobs = None
+        self.deleted_manifests = 0
+        self.deleted_blobs = 0
+        
+        self._clock = clock
+        self._started_at = clock()
+        self._sweep_started_at = None
+        self._reported_at = self._started_at
+        self._lock = threading.Lock()
+        self._logger = logging.getLogger(self.__class__.__name__)
+    
+    def feed(self, line):
+        """Parses single line of garbage collector output."""
+        with self._lock:
+            self._parse(line)
+            
+            if self._clock() - self._reported_at >= self.interval:
+                self._reported_at = self._clock()
+                self._logger.info("%s", self.format_progress())
+    
+    def _parse(self, line):
+        m = self._re_marking.match(line)
+        if m:
+            if m.group(2) == "manifest":
+                self.marked_manifests += 1
+            else:
+                self.marked_blobs += 1
+            return
+        
+        m = self._re_deleting.search(line)
+        if m:
+            if m.group(1).lower() == "deleting blob":
+                self.deleted_blobs += 1
+            else:
+                self.deleted_manifests += 1
+            return
+        
+        if self._re_eligible_manifest.match(line):
+            self.eligible_manifests += 1
+            return
+        
+        m = self._re_summary.match(line)
+        if m:
+            self.phase = "sweep"
+            self._sweep_started_at = self._clock()
+            self.marked_blobs = int(m.group(1))
+            self.eligible_blobs = int(m.group(2))
+            self.eligible_manifests = int(m.group(3))
+            return
+        
+        if self.phase == "mark" and self._re_repository.match(line):
+            self.scanned_repositories += 1
+    
+    def get_eta(self):
+        """Returns estimated number of seconds to finish current phase or ``None`` when it cannot be estimated."""
+        now = self._clock()
+        
+        if self.phase == "mark":
+            if not self.repositories or not self.scanned_repositories:
+                return None
+            rate = (now - self._started_at) / self.scanned_repositories
+            return max(0, self.repositories - self.scanned_repositories) * rate
+        
+        if not self.deleted_blobs:
+            return None
+        rate = (now - self._sweep_started_at) / self.deleted_blobs
+        return max(0, self.eligible_blobs - self.deleted_blobs) * rate
+    
+    def format_progress(self):
+        eta = self.get_eta()
+        eta = "unknown" if eta is None else "%ds" % eta
+        
+        if self.phase == "mark":
+            total = "/%d" % self.repositories if self.repositories else ""
+            return "Marking: %d%s repositories, %d manifests, %d blobs marked, ETA %s" % (
+                self.scanned_repositories, total, self.marked_manifests, self.marked_blobs, eta
+            )
+        
+        return "Sweeping: %d/%d blobs deleted, %d manifests deleted, ETA %s" % (
+            self.deleted_blobs, self.eligible_blobs, self.deleted_manifests, eta
+        )
+    
+    def get_result(self):
+        """Returns collected statistics.
+        
+        :rtype: GarbageCollectResult
+        """
+        with self._lock:
+            result = GarbageCollectResult()
+            result.marked_manifests = self.marked_manifests
+            result.marked_blobs = self.marked_blobs
+            result.eligible_manifests = self.eligible_manifests
+            result.eligible_blobs = self.eligible_blobs or 0
+            result.deleted_blobs = self.deleted_blobs
+            result.deleted_manifests = self.deleted_manifests
+            result.scanned_repositories = self.scanned_repositories
+            return result
+
+class UploadsPurgeResult(object):
+    """Statistics of stale uploads purge."""
+    
+    def __init__(self):
+        super(UploadsPurgeResult, self).__init__()
+        
+        self.removed_uploads = 0
+        self.freed_bytes = 0
+    
+    def __repr__(self):
+        return "<%s removed_uploads=%d freed_bytes=%d>" % (self.__class__.__name__, self.removed_uploads, self.freed_bytes)
+
+class ReachabilityIndex(object):
+    """Persistent index of blobs referenced by each repository, stored in SQLite database.
+    
+    Keeps reference counts for blobs so referenced set does not have to be rebuilt from all repositories.
+    Stored blobs are remembered along with stamps of their directories, so only changed directories are listed again.
+    """
+    
+    _schema_version = 2
+    
+    def __init__(self, path, registry_path):
+        """
+        :param path: Path to index database file.
+        :type path: str
+        :param registry_path: Path to indexed registry datadir, index is reset when it changes.
+        :type registry_path: str
+        """
+        super(ReachabilityIndex, self).__init__()
+        
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self._db = sqlite3.connect(path)
+        self._released = set()
+        self._setup(os.path.realpath(registry_path))
+    
+    def _setup(self, registry_path):
+        db = self._db
+        db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        meta = dict(db.execute("SELECT key, value FROM meta"))
+        
+        if meta.get("version") != str(self._schema_version) or meta.get("registry_path") != registry_path:
+            if meta:
+                self._logger.info("Index was created for other registry data, rebuilding")
+            db.executescript("""
+                DROP TABLE IF EXISTS repositories;
+                DROP TABLE IF EXISTS refs;
+                DROP TABLE IF EXISTS blobs;
+                DROP TABLE IF EXISTS stored;
+                DROP TABLE IF EXISTS prefixes;
+                DELETE FROM meta;
+            """)
+            db.executemany("INSERT INTO meta (key, value) VALUES (?, ?)", (
+                ("version", str(self._schema_version)),
+                ("registry_path", registry_path),
+            ))
+        
+        db.executescript("""
+            CREATE TABLE IF NOT EXISTS repositories (name TEXT PRIMARY KEY, fingerprint TEXT, tags_count INTEGER);
+            CREATE TABLE IF NOT EXISTS refs (repository TEXT, blob TEXT, PRIMARY KEY (repository, blob));
+            CREATE TABLE IF NOT EXISTS blobs (digest TEXT PRIMARY KEY, refcount INTEGER);
+            CREATE TABLE IF NOT EXISTS stored (digest TEXT PRIMARY KEY, prefix TEXT);
+            CREATE INDEX IF NOT EXISTS stored_prefix ON stored (prefix);
+            CREATE TABLE IF NOT EXISTS prefixes (prefix TEXT PRIMARY KEY, stamp TEXT);
+        """)
+        db.commit()
+    
+    def get_repositories(self):
+        """Returns indexed repositories with their fingerprints and tags count."""
+        return dict((name, (fingerprint, tags_count)) for name, fingerprint, tags_count in self._db.execute(
+            "SELECT name, fingerprint, tags_count FROM repositories"
+        ))
+    
+    def _change_refcounts(self, blobs, delta):
+        db = self._db
+        db.executemany("INSERT OR IGNORE INTO blobs (digest, refcount) VALUES (?, 0)", ((i,) for i in blobs))
+        db.executemany("UPDATE blobs SET refcount = refcount + ? WHERE digest = ?", ((delta, i) for i in blobs))
+    
+    def update_repository(self, name, fingerprint, tags_count, blobs):
+        """Replaces blobs referenced by given repository, updating reference counts by difference only."""
+        db = self._db
+        old = set(i for i, in db.execute("SELECT blob FROM refs WHERE repository = ?", (name,)))
+        added = blobs.difference(old)
+        removed = old.difference(blobs)
+        
+        db.executemany("INSERT INTO refs (repository, blob) VALUES (?, ?)", ((name, i) for i in added))
+        db.executemany("DELETE FROM refs WHERE repository = ? AND blob = ?", ((name, i) for i in removed))
+        self._change_refcounts(added, 1)
+        self._change_refcounts(removed, -1)
+        self._released.update(removed)
+        
+        db.execute("INSERT OR REPLACE INTO repositories (name, fingerprint, tags_count) VALUES (?, ?, ?)", (name, fingerprint, tags_count))
+        
+        return len(added), len(removed)
+    
+    def remove_repository(self, name):
+        """Removes repository and references to its blobs."""
+        self.update_repository(name, None, 0, set())
+        self._db.execute("DELETE FROM repositories WHERE name = ?", (name,))
+    
+    def is_referenced(self, digest):
+        return self._db.execute("SELECT 1 FROM blobs WHERE digest = ? AND refcount > 0", (digest,)).fetchone() is not None
+    
+    def count_referenced(self):
+        return self._db.execute("SELECT COUNT(*) FROM blobs WHERE refcount > 0").fetchone()[0]
+    
+    def get_released(self):
+        """Returns blobs that stopped being referenced by any repository since index was opened."""
+        return set(i for i in self._released if not self.is_referenced(i))
+    
+    def get_prefixes(self):
+        """Returns stamps of blob directories saved by :meth:`.set_prefix`."""
+        return dict(self._db.execute("SELECT prefix, stamp FROM prefixes"))
+    
+    def set_prefix(self, prefix, stamp, digests=None):
+        """Saves stamp of blob directory and, when given, blobs stored in it."""
+        db = self._db
+        db.execute("INSERT OR REPLACE INTO prefixes (prefix, stamp) VALUES (?, ?)", (prefix, stamp))
+        if digests is not None:
+            db.execute("DELETE FROM stored WHERE prefix = ?", (prefix,))
+            db.executemany("INSERT INTO stored (digest, prefix) VALUES (?, ?)", ((i, prefix) for i in digests))
+    
+    def remove_prefix(self, prefix):
+        self._db.execute("DELETE FROM prefixes WHERE prefix = ?", (prefix,))
+        self._db.execute("DELETE FROM stored WHERE prefix = ?", (prefix,))
+    
+    def is_stored(self, digest):
+        return self._db.execute("SELECT 1 FROM stored WHERE digest = ?", (digest,)).fetchone() is not None
+    
+    def remove_stored(self, digest):
+        self._db.execute("DELETE FROM stored WHERE digest = ?", (digest,))
+        self._db.execute("DELETE FROM blobs WHERE digest = ?", (digest,))
+    
+    def commit(self):
+        self._db.commit()
+    
+    def close(self):
+        self._db.close()
+
+class _RepositoryMarks(object):
+    def __init__(self, name, fingerprint, tags_count, manifests=None, untagged=None):
+        super(_RepositoryMarks, self).__init__()
+        
+        self.name = name
+        self.fingerprint = fingerprint
+        self.tags_count = tags_count
+        self.manifests = manifests
+        self.untagged = untagged
+    
+    @property
+    def changed(self):
+        return self.manifests is not None
+
+class GarbageCollector(object):
+    """Mark-and-sweep garbage collector working directly on registry data dir.
+    
+    Works as ``registry garbage-collect --delete-untagged=true`` but walks repositories concurrently
+    and can remove repositories without tags in the same run.
+    Registry should not be running when collecting garbage.
+    
+    When path to index is given, blobs referenced by each repository are saved in :class:`.ReachabilityIndex`
+    and only repositories changed since previous run are marked again.
+    """
+    
+    def __init__(self, registry_storage: RegistryStorage):
+        """
+        :param registry_storage: Storage to collect garbage in.
+        :type registry_storage: RegistryStorage
+        """
+        super(GarbageCollector, self).__init__()
+        
+        self._storage = registry_storage
+        self._logger = logging.getLogger(self.__class__.__name__)
+    
+    def _mark_repository(self, name, references, indexed, removed_tags=()):
+        fingerprint = self._storage.get_repository_fingerprint(name)
+        
+        if not removed_tags and name in indexed and indexed[name][0] == fingerprint:
+            return _RepositoryMarks(name, fingerprint, indexed[name][1])
+        
+        tags = dict((t, d) for t, d in self._storage.get_tagged_manifests(name).items() if t not in removed_tags)
+        blobs, manifests = self._storage.get_reachable(set(tags.values()), references)
+        untagged = self._storage.get_manifest_revisions(name).difference(manifests)
+        
+        return _RepositoryMarks(name, fingerprint, len(tags), blobs, untagged)
+    
+    def collect(self, remove_empty_repositories=True, jobs=4, index_path=None, dry_run=False, removed_tags=None):
+        """Removes untagged manifests and blobs not referenced by any tagged manifest.
+        
+        In dry run mode nothing is removed, neither from data dir nor from index, which is updated on a temporary copy,
+        and returned result tells what would be removed.
+        Tags given in ``removed_tags`` are treated as already removed, so collection after untagging can be simulated.
+        
+        :param remove_empty_repositories: Remove whole repositories without tags.
+        :type remove_empty_repositories: bool
+        :param jobs: Number of repositories marked concurrently.
+        :type jobs: int
+        :param index_path: Optional path to persistent index, enables incremental marking.
+        :type index_path: str
+        :param dry_run: Only count what would be removed.
+        :type dry_run: bool
+        :param removed_tags: Tags to ignore, keyed by repository name.
+        :type removed_tags: dict
+        :rtype: GarbageCollectResult
+        """
+        if index_path and dry_run:
+            with tempfile.TemporaryDirectory() as d:
+                copy_path = "%s/index.sqlite" % d
+                if os.path.exists(index_path):
+                    shutil.copyfile(index_path, copy_path)
+                return self._collect(remove_empty_repositories, jobs, copy_path, dry_run, removed_tags)
+        
+        return self._collect(remove_empty_repositories, jobs, index_path, dry_run, removed_tags)
+    
+    def _find_indexed_garbage(self, index):
+        """Returns blobs not referenced anymore, listing only blob directories changed since previous run.
+        
+        Unreferenced blobs were removed by previous run, so in unchanged directories only blobs
+        released by repositories marked in this run can be garbage.
+        """
+        garbage = set()
+        stamps = self._storage.get_blob_prefixes()
+        known = index.get_prefixes()
+        
+        for prefix in set(known.keys()).difference(stamps.keys()):
+            index.remove_prefix(prefix)
+        
+        for prefix, stamp in stamps.items():
+            if known.get(prefix) == stamp:
+                continue
+            digests = tuple(self._storage.iter_prefix_blobs(prefix))
+            index.set_prefix(prefix, stamp, digests)
+            garbage.update(i for i in digests if not index.is_referenced(i))
+        
+        garbage.update(i for i in index.get_released() if index.is_stored(i))
+        
+        return sorted(garbage)
+    
+    def _collect(self, remove_empty_repositories, jobs, index_path, dry_run, removed_tags):
+        self._logger.info("Running native garbage collector%s", " in dry run mode" if dry_run else "")
+        
+        removed_tags = removed_tags or {}
+        index = ReachabilityIndex(index_path, self._storage.registry_path) if index_path else None
+        indexed = index.get_repositories() if index else {}
+        
+        result = GarbageCollectResult()
+        marked = set()
+        references = {}
+        found = set()
+        
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+            marks = executor.map(
+                lambda name: self._mark_repository(name, references, indexed, removed_tags.get(name, ())),
+                self._storage.iter_repositories(jobs)
+            )
+            
+            for repo in marks:
+                result.scanned_repositories += 1
+                
+                if remove_empty_repositories and repo.tags_count == 0:
+                    self._logger.info("Removing data for repository %s", repo.name)
+                    if not dry_run:
+                        self._storage.remove_repository(repo.name)
+                    result.removed_repositories += 1
+                    continue
+                
+                found.add(repo.name)
+                
+                if not repo.changed:
+                    result.unchanged_repositories += 1
+                    continue
+                
+                marked.update(repo.manifests)
+                for digest in repo.untagged:
+                    self._logger.debug("Removing untagged manifest %s@%s", repo.name, digest)
+                    if not dry_run:
+                        self._storage.remove_manifest(repo.name, digest)
+                    result.deleted_manifests += 1
+                
+                if index:
+                    # removing manifests changes repository so fingerprint has to be updated
+                    fingerprint = self._storage.get_repository_fingerprint(repo.name) if repo.untagged else repo.fingerprint
+                    index.update_repository(repo.name, fingerprint, repo.tags_count, repo.manifests)
+        
+        if index:
+            for name in set(indexed.keys()).difference(found):
+                index.remove_repository(name)
+            result.marked_blobs = index.count_referenced()
+            garbage = self._find_indexed_garbage(index)
+        else:
+            result.marked_blobs = len(marked)
+            garbage = (i for i in self._storage.iter_blobs() if i not in marked)
+        
+        changed_prefixes = set()
+        for digest in garbage:
+            self._logger.debug("Deleting blob %s", digest)
+            result.freed_bytes += self._storage.get_blob_size(digest)
+            if not dry_run:
+                self._storage.remove_blob(digest)
+                changed_prefixes.add(self._storage.get_blob_prefix(digest))
+            if index:
+                index.remove_stored(digest)
+            result.deleted_blobs += 1
+        
+        if index:
+            # removed blobs changed their directories, new stamps are saved so they are not listed again
+            for prefix in changed_prefixes:
+                index.set_prefix(prefix, self._storage.get_prefix_stamp(prefix))
+            index.commit()
+            index.close()
+        
+        result.eligible_manifests = result.deleted_manifests
+        result.eligible_blobs = result.deleted_blobs
+        
+        self._logger.info("Garbage collection finished: %r", result)
+        
+        return result
+
+class SpaceEstimate(object):
+    """Space that would be reclaimed by removing selected tags."""
+    
+    def __init__(self):
+        super(SpaceEstimate, self).__init__()
+        
+        self.repositories = OrderedDict()
+        """Bytes referenced only by removed tags of given repository."""
+        self.shared_bytes = 0
+        """Bytes referenced by removed tags of more than one repository."""
+        self.total_bytes = 0
+        self.blobs = 0
+        self.garbage_collect = None
+        """Result of garbage collection dry run after removing tags, includes garbage left by previous runs."""
+    
+    def __repr__(self):
+        return "<%s total_bytes=%d shared_bytes=%d blobs=%d garbage_collect=%r>" % (
+            self.__class__.__name__, self.total_bytes, self.shared_bytes, self.blobs, self.garbage_collect
+        )
+
+class SpaceEstimator(object):
+    """Estimates space reclaimed by removing tags, using registry data dir.
+    
+    Manifests graph is walked once: blobs reachable from removed tags are reclaimable
+    only when no other tag, in any repository, references them.
+    """
+    
+    def __init__(self, registry_storage: RegistryStorage):
+        """
+        :param registry_storage: Storage to estimate space in.
+        :type registry_storage: RegistryStorage
+        """
+        super(SpaceEstimator, self).__init__()
+        
+        self._storage = registry_storage
+        self._logger = logging.getLogger(self.__class__.__name__)
+    
+    def _split_repository(self, name, removed_tags, references):
+        tagged = self._storage.get_tagged_manifests(name)
+        
+        kept = set(d for t, d in tagged.items() if t not in removed_tags)
+        removed = set(d for t, d in tagged.items() if t in removed_tags).difference(kept)
+        
+        return self._storage.get_reachable(kept, references)[0], self._storage.get_reachable(removed, references)[0]
+    
+    def estimate_repository(self, name, removed_tags, references=None):
+        """Quickly estimates space reclaimed by removing tags from single repository.
+        
+        Blobs shared with other repositories are not looked for, so estimate can be too high,
+        but it is good enough to compare repositories.
+        
         :param name: Repository name.
         :type name: str
+        :param removed_tags: Tags to remove.
+        :type removed_tags: iterable
+        :param references: Optional dict used to cache manifests references.
+        :type references: dict
+        :rtype: int
+        """
+        if not removed_tags:
+            return 0
         
+        kept, removed = self._split_repository(name, set(removed_tags), {} if references is None else references)
+        return sum(self._storage.get_blob_size(d) for d in removed.difference(kept))
+    
+    def estimate(self, removed_tags, jobs=4):
+        """Estimates reclaimable space.
+        
+        :param removed_tags: Tags to remove, keyed by repository name.
+        :type removed_tags: dict
+        :param jobs: Number of repositories scanned concurrently.
+        :type jobs: int
+        :rtype: SpaceEstimate
         """
-        shutil.rmtree(self._get_repository_path(name))
+        estimate = SpaceEstimate()
+        references = {}
+        kept = set()
+        removed = OrderedDict()
+        
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+            names = tuple(self._storage.iter_repositories())
+            splits = executor.map(lambda name: self._split_repository(name, removed_tags.get(name, ()), references), names)
+            
+            for name, (repo_kept, repo_removed) in zip(names, splits):
+                kept.update(repo_kept)
+                if repo_removed:
+                    removed[name] = repo_removed
+        
+        owners = {}
+        for name, blobs in removed.items():
+            for digest in blobs.difference(kept):
+                owners.setdefault(digest, []).append(name)
+        
+        for name in removed.keys():
+            estimate.repositories[name] = 0
+        
+        for digest, names in owners.items():
+            size = self._storage.get_blob_size(digest)
+            estimate.total_bytes += size
+            estimate.blobs += 1
+            if len(names) > 1:
+                estimate.shared_bytes += size
+            else:
+                estimate.repositories[names[0]] += size
+        
+        self._logger.info("Space estimate: %r", estimate)
+        
+        return estimate
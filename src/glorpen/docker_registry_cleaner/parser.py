@@ -29,6 +29,13 @@ class RepoConfigField(fields.Field):
         
         return [type_, s.resolve(value)]
 
+class FloatField(fields.Number):
+    """Converts value to float number."""
+    
+    def _normalize(self, value, config):
+        if value is not None:
+            return float(value)
+
 class Loader(object):
     def __init__(self, path):
         super(Loader, self).__init__()
@@ -51,6 +58,18 @@ class Loader(object):
                         ) 
                     })
                 ),
+                "registry": fields.Dict({
+                    "page_size": fields.Number(allow_blank=True),
+                    "concurrency": fields.Number(default=8),
+                    "pool_size": fields.Number(allow_blank=True),
+                    "timeout": FloatField(allow_blank=True),
+                    "retries": fields.Number(default=0),
+                    "backoff": FloatField(default=0.5),
+                    "cache": fields.Dict({
+                        "max_size": fields.Number(default=16*1024*1024),
+                        "path": fields.String(allow_blank=True),
+                    }),
+                }),
                 **self._selector_configs_schemas
         })
 
@@ -12,6 +12,38 @@ def flatten(items):
         else:
             yield i
 
+class TagTable(object):
+    """Tags shared by chained selectors.
+    
+    Tags are claimed by selectors one after another, claimed tags are either kept
+    or marked for deletion and are not passed to next selectors.
+    """
+    
+    def __init__(self, tags):
+        super(TagTable, self).__init__()
+        
+        self._tags = set(tags)
+        self._unclaimed = sorted(self._tags, reverse=True)
+        self._kept = set()
+    
+    @property
+    def unclaimed(self):
+        """Tags not claimed by any selector yet, sorted in reverse order."""
+        return self._unclaimed
+    
+    def claim(self, kept, unmatched):
+        """Claims all unclaimed tags except unmatched ones.
+        
+        :param kept: Claimed tags that should be kept, other claimed tags are marked for deletion.
+        :param unmatched: Tags left for next selectors, in order.
+        """
+        self._kept.update(kept)
+        self._unclaimed = unmatched
+    
+    def get_deleted(self):
+        """Returns claimed tags that were not kept."""
+        return self._tags.difference(self._kept, self._unclaimed)
+
 class BaseSelector(object):
     def __init__(self, runtime_config, config=None):
         super(BaseSelector, self).__init__()
@@ -24,6 +56,11 @@ class BaseSelector(object):
         #return [], tags
         raise NotImplementedError()
     
+    def claim(self, table):
+        """Claims tags from given :class:`.TagTable`, only unclaimed tags are passed to :meth:`.select`."""
+        selected, unmatched = self.select(table.unclaimed)
+        table.claim(selected, unmatched)
+    
     def _setup(self, **kwargs):
         if kwargs:
             raise Exception("Unused arguments %r" % list(kwargs.keys()))
@@ -8,9 +8,40 @@ import glorpen.config.fields as fields
 import glorpen.config.exceptions as config_exceptions
 from collections import OrderedDict
 import itertools
+import functools
+import bisect
 
 exp_parser = ExpressionParser()
 
+_inf = float("inf")
+
+class ParsedVersion(object):
+    """Semantic version parsed from tag.
+    
+    Version is identified by ``key``, a tuple of major, minor and patch numbers.
+    """
+    __slots__ = ("tag", "key")
+    
+    def __init__(self, tag, info):
+        super(ParsedVersion, self).__init__()
+        
+        self.tag = tag
+        self.key = (info.major, info.minor, info.patch)
+
+@functools.lru_cache(maxsize=65536)
+def parse_version(tag):
+    """Returns :class:`.ParsedVersion` for given tag or ``None`` when it is not a semantic version.
+    
+    Results are cached, so tags shared by many repositories are parsed only once.
+    """
+    try:
+        return ParsedVersion(tag, semver.VersionInfo.parse(tag))
+    except ValueError:
+        return None
+
+def format_key(key):
+    return ".".join(str(i) for i in key)
+
 class Expression(object):
     def __init__(self, value=None, min=None, max=None):
         super(Expression, self).__init__()
@@ -19,18 +50,19 @@ class Expression(object):
         self._min = min
         self._max = max
         
-    def get_filter(self, **kwargs):
+    def get_range(self, **kwargs):
+        """Returns inclusive lower and upper bound of matched values, ``None`` when not bounded."""
         if self._min or self._max:
             l_min = self._min.evaluate(kwargs) if self._min else None
             l_max = self._max.evaluate(kwargs) if self._max else None
             
-            return lambda x: (l_min is None or x>=l_min) and (l_max is None or x<=l_max)
+            return l_min, l_max
         
         if self._value:
             v = self._value.evaluate(kwargs)
-            return lambda x: x == v
+            return v, v
         
-        return lambda x: True
+        return None, None
 
 class ConfigExpressionField(fields.Variant):
     def __init__(self, **kwargs):
@@ -75,71 +107,96 @@ class SemVerSelector(MaxSelector):
         super(SemVerSelector, self)._setup(**kwargs)
         
         self._groups = [];
+        self._ranges_cache = {}
         
         for name, g_conf in groups.items():
             self._setup_group(name, **g_conf)
         
     def _setup_group(self, name, where, preserve, max_items=None):
-        self._groups.append((name, where, preserve, max_items))
-        #prep_where = self._prepare_group_where(**where)
+        prep_where = self._prepare_group_where(**where)
+        self._groups.append((name, prep_where, preserve, max_items))
         #prep_preserve = self._prepare_group_preserve(**preserve)
     
     def _prepare_group_where(self, major=None, minor=None, patch=None, build=None):
-        pass
+        # expressions ordered by version key position
+        return (major, minor, patch)
     
     def _prepare_group_preserve(self, major=None, minor=None, patch=None, build=None):
         pass
     
-    def _get_where_filters(self, where, latest_ver):
-        where_filters = {}
-        for pos, exp in where.items():
-            latest = getattr(latest_ver, pos) or 0
-            f = exp.get_filter(latest=latest)
-            where_filters[pos] = f
+    def _get_where_ranges(self, where, latest_ver):
+        """Evaluates group expressions to bounds for each version key position.
+        
+        Bounds are cached by latest version, so expressions are evaluated once per run for most repositories.
+        """
+        cache_key = (id(where), latest_ver)
+        if cache_key not in self._ranges_cache:
+            ranges = [exp.get_range(latest=latest_ver[i]) if exp else (None, None) for i, exp in enumerate(where)]
+            while ranges and ranges[-1] == (None, None):
+                ranges.pop()
+            self._ranges_cache[cache_key] = tuple(ranges)
         
-        return where_filters
+        return self._ranges_cache[cache_key]
     
-    def _are_where_filters_matched(self, where_filters, version):
-        for k,f in where_filters.items():
-            if not f(getattr(version, k) or 0):
-                return False
-        return True
+    def _find_versions(self, versions, ranges, lo=0, hi=None, prefix=()):
+        """Yields versions matching bounds, versions list has to be sorted.
+        
+        Matched versions sharing same prefix are always adjacent so they are found by bisection,
+        only keys with further bounds are split by distinct values.
+        """
+        if hi is None:
+            hi = len(versions)
+        
+        pos = len(prefix)
+        if pos >= len(ranges):
+            yield from versions[lo:hi]
+            return
+        
+        l_min, l_max = ranges[pos]
+        if l_min is not None:
+            lo = bisect.bisect_left(versions, prefix + (l_min,), lo, hi)
+        if l_max is not None:
+            hi = bisect.bisect_right(versions, prefix + (l_max, _inf), lo, hi)
+        
+        if pos + 1 >= len(ranges):
+            yield from versions[lo:hi]
+            return
+        
+        while lo < hi:
+            value_prefix = prefix + (versions[lo][pos],)
+            value_hi = bisect.bisect_right(versions, value_prefix + (_inf,), lo, hi)
+            yield from self._find_versions(versions, ranges, lo, value_hi, value_prefix)
+            lo = value_hi
     
     def _group_versions_by_keys(self, versions, offset):
-        def _worker(x):
-            values = []
-            for k in self._ver_keys[0:offset+1]:
-                values.append(str(getattr(x, k) or 0))
-            
-            return ".".join(values)
-        
-        return itertools.groupby(versions, _worker)
+        return itertools.groupby(versions, lambda x: x[0:offset+1])
     
     def _split_versions(self, real_versions):
         
         selected = []
         
         if real_versions:
-            grouped_versions = OrderedDict((k,tuple(v)) for k,v in self._group_versions_by_keys(real_versions, len(self._ver_keys)-1))
-            versions = [semver.VersionInfo.parse(v) for v in grouped_versions.keys()]
-            free_versions = set(versions)
+            # versions with different pre-release and build metadata are counted as one
+            grouped_versions = OrderedDict()
+            for v in real_versions:
+                grouped_versions.setdefault(v.key, []).append(v.tag)
+            
+            versions = sorted(grouped_versions.keys())
+            claimed_versions = set()
             
-            latest_ver = max(versions)
-            self.logger.debug("detected latest version: %s", latest_ver)
+            latest_ver = versions[-1]
+            self.logger.debug("detected latest version: %s", format_key(latest_ver))
             
             for name, where, preserve, max_items in self._groups:
                 self.logger.debug("Searching for %s", name)
-                where_filters = self._get_where_filters(where, latest_ver)
+                ranges = self._get_where_ranges(where, latest_ver)
                 
-                matched = set()
-                for v in free_versions:
-                    if self._are_where_filters_matched(where_filters, v):
-                        matched.add(v)
-                        self.logger.debug("Matched %s", v)
+                matched = [v for v in self._find_versions(versions, ranges) if v not in claimed_versions]
+                claimed_versions.update(matched)
                 
-                free_versions.difference_update(matched)
-                
-                matched = OrderedDict((str(i),i) for i in sorted(matched, reverse=True))
+                matched = OrderedDict((i,i) for i in reversed(matched))
+                for i in matched:
+                    self.logger.debug("Matched %s", format_key(i))
                 
                 for i, k in enumerate(self._ver_keys):
                     
@@ -147,34 +204,30 @@ class SemVerSelector(MaxSelector):
                     if k_preserve is None:
                         continue
                     
-                    # versions with different build metadata should be counted as one
                     grouped = self._group_versions_by_keys(list(matched.values()), i-1)
                     
                     for _group_key, items in grouped:
                         items = list(items)
                         for i in items:
-                            del matched[str(i)]
+                            del matched[i]
                         for i in items[:k_preserve]:
-                            self.logger.debug("Selected %s", i)
-                            selected.extend(grouped_versions[str(i)])
+                            self.logger.debug("Selected %s", format_key(i))
+                            selected.extend(grouped_versions[i])
             
-        return [str(i) for i in set(selected)]
+        return list(OrderedDict.fromkeys(selected))
     
     def select(self, tags):
         unmatched = []
         selected = []
         
         for t in tags:
-            try:
-                v = semver.VersionInfo.parse(t)
-            except ValueError:
+            v = parse_version(t)
+            if v is None:
                 unmatched.append(t)
-                continue
-            
-            selected.append(v)
+            else:
+                selected.append(v)
         
-        versions = sorted(selected)
-        return self._split_versions(versions), unmatched
+        return self._split_versions(selected), unmatched
     
     @classmethod
     def get_config_fields(cls):
@@ -28,9 +28,128 @@ class MaxSelector(base.BaseSelector):
             "max_items": fields.Number(allow_blank=True)
         }
 
+class PatternMatcher(object):
+    """Matches text against group of patterns using single combined regex.
+    
+    Each pattern becomes named alternative of combined regex so matched pattern is found in one scan
+    and replacement is expanded from the same match, using template parsed once.
+    Patterns using backreferences, inline flags or context dependent assertions
+    are matched one by one, as combining them could change results.
+    """
+    
+    _re_unsupported = re.compile(r'\\[1-9bB]|\(\?(?:<[=!]|\()')
+    _re_template_group = re.compile(r'\\(?:g<([^>]*)>|([0-9]+)|.)', re.S)
+    _re_empty = re.compile("")
+    _default_flags = _re_empty.flags
+    
+    def __init__(self, patterns):
+        """
+        :param patterns: Tuple of compiled pattern and optional replacement pairs.
+        :type patterns: tuple
+        """
+        super(PatternMatcher, self).__init__()
+        
+        self.patterns = patterns
+        self._combined = None
+        self._alternatives = {}
+        
+        try:
+            self._combine()
+        except (re.error, ValueError):
+            self._combined = None
+            self._alternatives = {}
+    
+    def _compile_template(self, template, rp, offset, groupindex):
+        """Splits replacement template into literal strings and group numbers in combined regex."""
+        parts = []
+        pos = 0
+        
+        for m in self._re_template_group.finditer(template):
+            if m.start() > pos:
+                parts.append(template[pos:m.start()])
+            pos = m.end()
+            
+            name, number = m.group(1), m.group(2)
+            if number is None and name is not None and name.isdigit():
+                number = name
+            
+            if number is not None:
+                # three digits are octal escapes
+                if len(number) > 2 or (number.startswith("0") and name is None) or int(number) > rp.groups:
+                    raise ValueError("Unsupported group reference in template %r" % template)
+                parts.append(int(number) + offset)
+            elif name is not None:
+                # names are unique in combined regex but have to belong to current pattern
+                if name not in rp.groupindex:
+                    raise ValueError("Unknown group %r in template %r" % (name, template))
+                parts.append(groupindex[name])
+            else:
+                # let re module resolve other escapes
+                parts.append(self._re_empty.sub(m.group(0), ""))
+        
+        if pos < len(template):
+            parts.append(template[pos:])
+        
+        return tuple(parts)
+    
+    def _combine(self):
+        parts = []
+        offsets = []
+        offset = 0
+        
+        for i, (rp, rr) in enumerate(self.patterns):
+            if rp.flags != self._default_flags or self._re_unsupported.search(rp.pattern):
+                raise ValueError("Pattern %r cannot be combined" % rp.pattern)
+            
+            offset += 1
+            parts.append("(?P<_alt%d>%s)" % (i, rp.pattern))
+            offsets.append(offset)
+            offset += rp.groups
+        
+        combined = re.compile("|".join(parts))
+        
+        for i, (rp, rr) in enumerate(self.patterns):
+            template = self._compile_template(rr, rp, offsets[i], combined.groupindex) if rr else None
+            # patterns matching empty string would match again at the end of text when substituting
+            self._alternatives["_alt%d" % i] = (rp, rr, template, rp.match("") is not None)
+        
+        self._combined = combined
+    
+    def _match_sequential(self, text):
+        for rp, rr in self.patterns:
+            m = rp.match(text)
+            if m:
+                if rr:
+                    s = rp.sub(rr, text)
+                    return s
+                else:
+                    return None
+        return False
+    
+    def match(self, text):
+        """Returns ``False`` when no pattern matches, ``None`` when matched pattern has no replacement
+        or text with replaced pattern."""
+        if self._combined is None:
+            return self._match_sequential(text)
+        
+        m = self._combined.match(text)
+        if m is None:
+            return False
+        
+        rp, rr, template, matches_empty = self._alternatives[m.lastgroup]
+        if not rr:
+            return None
+        
+        if m.end() == len(text) and not matches_empty:
+            return "".join(p if isinstance(p, str) else (m.group(p) or "") for p in template)
+        
+        # pattern could match again in remaining text
+        return rp.sub(rr, text)
+
 class PatternSelectorConfig(base.BaseSelectorConfig):
     def _parse_config(self, config):
         self.patterns = self._get_patterns(config)
+        self.matchers = dict((k, PatternMatcher(v)) for k, v in self.patterns.items())
     
     def _get_patterns(self, patterns):
         ret = {}
@@ -67,18 +186,11 @@ class PatternSelector(MaxSelector):
             tags[:] = tags[0:max_items]
 
     def match(self, text):
-        for rp, rr in self.patterns:
-            m = rp.match(text)
-            if m:
-                if rr:
-                    s = rp.sub(rr, text)
-                    return s
-                else:
-                    return None
-        return False
+        return self._matcher.match(text)
     
     def _setup(self, pattern, **kwargs):
         self.patterns = self._config.patterns[pattern]
+        self._matcher = self._config.matchers[pattern]
         
         super(PatternSelector, self)._setup(**kwargs)
     
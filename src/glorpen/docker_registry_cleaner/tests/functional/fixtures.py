@@ -10,18 +10,19 @@ import os
 import contextlib
 from glorpen.docker_registry_cleaner import api
 
-def generate_config(repositories):
+def generate_config(repositories, registry=None):
     f = tempfile.NamedTemporaryFile(mode="w+t", delete=False)
     yaml.dump({
-        "repositories": repositories
+        "repositories": repositories,
+        "registry": registry
     }, f)
     f.close()
     
     return f.name
 
 @contextlib.contextmanager
-def _app(repositories):
-    config = generate_config(repositories)
+def _app(repositories, registry=None):
+    config = generate_config(repositories, registry)
     app = Cli().create_app(
         config,
         os.environ.get("REGISTRY_DATA", "/var/lib/registry"),
@@ -34,7 +35,7 @@ def _app(repositories):
         app.close()
 
 @contextlib.contextmanager
-def _registry(url="http://127.0.0.1:5000"):
-    registry = api.DockerRegistry(url, {})
+def _registry(url="http://127.0.0.1:5000", **kwargs):
+    registry = api.DockerRegistry(url, {}, **kwargs)
     yield registry
     registry.close()
\ No newline at end of file
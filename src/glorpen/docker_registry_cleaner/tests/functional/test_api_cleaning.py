@@ -4,7 +4,14 @@ Created on 4 kwi 2019
 @author: glorpen
 '''
 import unittest
+import tempfile
+import os
+import json
+import time
 from glorpen.docker_registry_cleaner.tests.functional import fixtures
+from glorpen.docker_registry_cleaner import api
+from glorpen.docker_registry_cleaner import app as app_module
+from glorpen.docker_registry_cleaner.console import Cli
 
 class TestApi(unittest.TestCase):
     
@@ -40,6 +47,71 @@ class TestApi(unittest.TestCase):
             app.clean()
             self.assertDictContainsSubset({"some-cleaning": ("2",)}, app.list_repos(), "Second image was not removed")
     
+    def test_cleaning_by_digest(self):
+        with fixtures._app(self._get_repositories_config(1)) as app:
+            with app._native.run():
+                with fixtures._registry() as r:
+                    r.upload_fake_image('digest-cleaning', '1', b'1515151511')
+                    r.tag('digest-cleaning', '1', '0')
+                    kept = r.upload_fake_image('digest-cleaning', '2', b'1515151512')
+                    r.tag('digest-cleaning', '2', '3')
+            app.clean()
+            self.assertDictContainsSubset({"digest-cleaning": ("3",)}, app.list_repos(), "Only newest tag is left")
+            with app._native.run():
+                with fixtures._registry() as r:
+                    self.assertEqual(r.get_reference('digest-cleaning', '3'), kept, "Image shared with kept tag is not removed")
+    
+    def _put_index(self, registry, repo, tag, children):
+        index = {
+            "schemaVersion": 2,
+            "mediaType": "application/vnd.oci.image.index.v1+json",
+            "manifests": [{"mediaType": "application/vnd.docker.distribution.manifest.v2+json", "digest": d, "size": 0} for d in children]
+        }
+        registry._put_manifest(repo, tag, (index["mediaType"], json.dumps(index).encode()))
+    
+    def test_cleaning_manifest_lists(self):
+        with fixtures._app(self._get_repositories_config(1)) as app:
+            with app._native.run():
+                with fixtures._registry() as r:
+                    removed_child = r.upload_fake_image('index-cleaning', '0', b'1616161610')
+                    kept_child = r.upload_fake_image('index-cleaning', '1', b'1616161611')
+                    self._put_index(r, 'index-cleaning', '2', [removed_child])
+                    self._put_index(r, 'index-cleaning', '3', [kept_child])
+                    r.tag('index-cleaning', '3', '4')
+                    
+                    self.assertEqual(r.get_manifest('index-cleaning', '4')["manifests"][0]["digest"], kept_child, "Index is tagged without conversion")
+            app.clean()
+            self.assertDictContainsSubset({"index-cleaning": ("4",)}, app.list_repos(), "Only newest tag is left")
+            with app._native.run():
+                with fixtures._registry() as r:
+                    self.assertEqual(r.get_children('index-cleaning', [r.get_reference('index-cleaning', '4')]).popitem()[1], (kept_child,))
+                    self.assertEqual(r.get_manifest('index-cleaning', kept_child)["config"]["size"], 10, "Child of kept index is not removed")
+    
+    def test_metrics(self):
+        with fixtures._app(self._get_repositories_config(1)) as app:
+            with app._native.run():
+                with fixtures._registry() as r:
+                    r.upload_fake_image('metrics-cleaning', '2', b'1717171712')
+                    r.upload_fake_image('metrics-cleaning', '1', b'1717171711')
+            app.clean(gc="native")
+            
+            self.assertEqual(app.metrics.get_counter("tags_examined_total", repository="metrics-cleaning"), 2)
+            self.assertEqual(app.metrics.get_counter("tags_selected_total", repository="metrics-cleaning"), 1)
+            self.assertGreater(app.metrics.get_counter("http_requests_total", endpoint="manifests", method="DELETE", status=202), 0)
+            self.assertGreater(app.metrics.get_counter("freed_bytes_total", source="gc"), 0)
+            self.assertEqual(set(app.metrics.get_report()["stages"].keys()), {"registry_start", "untagging", "native_gc"})
+    
+    def test_registry_gc_result(self):
+        with fixtures._app(self._get_repositories_config(1)) as app:
+            with app._native.run():
+                with fixtures._registry() as r:
+                    r.upload_fake_image('gc-result-cleaning', '2', b'1818181812')
+                    r.upload_fake_image('gc-result-cleaning', '1', b'1818181811')
+            app.clean(gc="registry")
+            
+            self.assertGreater(app.metrics.get_counter("blobs_deleted_total"), 0)
+            self.assertEqual(app.metrics.get_report()["stages"]["registry_gc"]["runs"], 2)
+    
     def test_cross_tagging(self):
         with fixtures._app(self._get_repositories_config(1)) as app:
             with app._native.run():
@@ -58,3 +130,308 @@ class TestApi(unittest.TestCase):
                     r.upload_fake_image('some-nested/name', 'latest', b'11111111111')
             app.clean()
             self.assertNotIn("some-nested", app.list_repos(), "No image after cleaning")
+    
+    def test_concurrent_cleaning(self):
+        with fixtures._app(self._get_repositories_config(1)) as app:
+            with app._native.run():
+                with fixtures._registry() as r:
+                    for i in range(5):
+                        r.upload_fake_image('concurrent-cleaning-%d' % i, '1', b'444444441%d' % i)
+                        r.upload_fake_image('concurrent-cleaning-%d' % i, '2', b'444444442%d' % i)
+            app.clean(jobs=3)
+            repos = app.list_repos()
+            for i in range(5):
+                self.assertEqual(repos['concurrent-cleaning-%d' % i], ("2",), "Older images are removed in each repo")
+    
+    def test_blob_mount(self):
+        with fixtures._app(self._get_repositories_config(0)) as app:
+            with app._native.run():
+                with fixtures._registry() as r:
+                    digest = r.upload_fake_image('mount-source', '1', b'131313131')
+                    self.assertEqual(r.upload_fake_image('mount-target', '1', b'131313131', mount_from='mount-source'), digest, "Blob is mounted")
+                    r.upload_fake_image('mount-fallback', '1', b'131313132', mount_from='mount-source')
+                    self.assertEqual(r.get_tags('mount-fallback'), ("1",), "Blob is uploaded when it cannot be mounted")
+    
+    def test_paginated_listing(self):
+        with fixtures._app(self._get_repositories_config(1), {"page_size": 2}) as app:
+            with app._native.run():
+                with fixtures._registry(page_size=2) as r:
+                    for i in range(5):
+                        r.upload_fake_image('paginated-cleaning-%d' % i, '1', b'555555551%d' % i)
+                        r.upload_fake_image('paginated-cleaning-%d' % i, '2', b'555555552%d' % i)
+                        r.upload_fake_image('paginated-cleaning-%d' % i, '3', b'555555553%d' % i)
+                    self.assertEqual(r.get_tags('paginated-cleaning-0'), ("1", "2", "3"), "All tags are listed")
+            app.clean()
+            repos = app.list_repos()
+            for i in range(5):
+                self.assertEqual(repos['paginated-cleaning-%d' % i], ("3",), "Repos from all pages are cleaned")
+    
+    def test_bulk_tagging(self):
+        with fixtures._registry() as r:
+            with fixtures._app(self._get_repositories_config(0)) as app:
+                with app._native.run():
+                    r.upload_fake_image('bulk-tagging', 'source', b'66666666661')
+                    failed = r.tag_many('bulk-tagging', 'source', ['t%d' % i for i in range(20)], concurrency=4)
+                    self.assertFalse(failed, "No tagging errors")
+                    self.assertEqual(len(r.get_tags('bulk-tagging')), 21, "All tags are created")
+    
+    def test_batched_references(self):
+        with fixtures._app(self._get_repositories_config(0)) as app:
+            with app._native.run():
+                with fixtures._registry() as r:
+                    first = r.upload_fake_image('batched-references', '1', b'141414141')
+                    second = r.upload_fake_image('batched-references', '2', b'141414142')
+                    r.tag('batched-references', '1', '3')
+                    
+                    references = r.get_references('batched-references', ['1', '2', '3', 'missing'], concurrency=2)
+                    self.assertEqual(list(references.items()), [('1', first), ('2', second), ('3', first), ('missing', None)])
+                    self.assertEqual(r.get_reference('batched-references', '2'), second)
+    
+    def test_persistent_manifest_cache(self):
+        with tempfile.TemporaryDirectory() as d:
+            cache_path = "%s/manifests.json" % d
+            with fixtures._app(self._get_repositories_config(0)) as app:
+                with app._native.run():
+                    with fixtures._registry(cache=api.ManifestCache(path=cache_path)) as r:
+                        digest = r.upload_fake_image('cached-tagging', 'source', b'12121212121')
+                    
+                    with fixtures._registry(cache=api.ManifestCache(path=cache_path)) as r:
+                        self.assertEqual(len(r._cache), 1, "Manifest is loaded from file")
+                        r.tag('cached-tagging', 'source', 'target', cache=True)
+                        self.assertEqual(r.get_reference('cached-tagging', 'target'), digest, "Image keeps its digest")
+    
+    def test_offline_cleaning(self):
+        with fixtures._app(self._get_repositories_config(1)) as app:
+            with app._native.run():
+                with fixtures._registry() as r:
+                    r.upload_fake_image('offline-cleaning', '2', b'7777777772')
+                    r.upload_fake_image('offline-cleaning', '1', b'7777777771')
+                    r.upload_fake_image('offline-cleaning/nested', '1', b'7777777773')
+            self.assertEqual(app.list_repos(offline=True)["offline-cleaning"], ("1", "2"), "Tags are read from data dir")
+            app.clean(offline=True)
+            repos = app.list_repos()
+            self.assertEqual(repos["offline-cleaning"], ("2",), "Older image was removed")
+            self.assertEqual(repos["offline-cleaning/nested"], ("1",), "Nested repo was cleaned")
+    
+    def test_native_garbage_collector(self):
+        with fixtures._app(self._get_repositories_config(1)) as app:
+            with app._native.run():
+                with fixtures._registry() as r:
+                    r.upload_fake_image('native-gc', '2', b'8888888882')
+                    r.upload_fake_image('native-gc', '1', b'8888888881')
+                    r.upload_fake_image('native-gc-shared', '2', b'8888888881')
+                    r.upload_fake_image('native-gc-shared', '1', b'8888888883')
+                    r.upload_fake_image('native-gc/nested', '1', b'8888888884')
+            app.clean(gc="native")
+            
+            storage = app._storage
+            blobs = set(storage.iter_blobs())
+            self.assertEqual(app.list_repos()["native-gc"], ("2",), "Older image was removed")
+            self.assertIn("native-gc/nested", app.list_repos(), "Nested repository is kept")
+            
+            for repo in ("native-gc", "native-gc-shared"):
+                for digest in storage.get_tagged_manifests(repo).values():
+                    self.assertIn(digest, blobs, "Tagged manifest is kept")
+                    self.assertTrue(blobs.issuperset(storage.get_manifest_references(digest)[0]), "Referenced blobs are kept")
+            
+            app.clean(gc="native")
+            self.assertEqual(blobs, set(storage.iter_blobs()), "Nothing more is collected")
+    
+    def test_incremental_garbage_collector(self):
+        index_dir = tempfile.TemporaryDirectory()
+        index_path = os.path.join(index_dir.name, "index.sqlite")
+        
+        with index_dir, fixtures._app(self._get_repositories_config(1)) as app:
+            with app._native.run():
+                with fixtures._registry() as r:
+                    r.upload_fake_image('incremental-gc', '2', b'9999999992')
+                    r.upload_fake_image('incremental-gc', '1', b'9999999991')
+                    r.upload_fake_image('incremental-gc-other', '1', b'9999999993')
+            app.clean(gc="native", gc_index=index_path)
+            blobs = set(app._storage.iter_blobs())
+            
+            result = app._gc.collect(index_path=index_path)
+            self.assertGreaterEqual(result.unchanged_repositories, 2, "Repositories are not marked again")
+            self.assertEqual(result.deleted_blobs, 0, "Nothing is collected from unchanged repositories")
+            
+            app._storage.remove_tags('incremental-gc-other', ['1'])
+            result = app._gc.collect(index_path=index_path)
+            self.assertEqual(result.removed_repositories, 1, "Changed repository is detected")
+            self.assertEqual(len(blobs) - len(set(app._storage.iter_blobs())), result.deleted_blobs, "Blobs of removed repository are collected")
+            self.assertGreater(result.deleted_blobs, 0, "Blobs of removed repository are collected")
+    
+    def test_pretend_space_estimate(self):
+        with fixtures._app(self._get_repositories_config(1)) as app:
+            with app._native.run():
+                with fixtures._registry() as r:
+                    r.upload_fake_image('estimate-first', '2', b'1010101012')
+                    r.upload_fake_image('estimate-first', '1', b'1010101011')
+                    r.upload_fake_image('estimate-second', '2', b'1010101013')
+                    r.upload_fake_image('estimate-second', '1', b'1010101011')
+                    r.upload_fake_image('estimate-third', '2', b'1010101014')
+                    r.upload_fake_image('estimate-third', '1', b'1010101014')
+            
+            estimate = app.clean(pretend=True)
+            self.assertEqual(app.list_repos()["estimate-first"], ("1", "2"), "Nothing is removed")
+            
+            storage = app._storage
+            shared = storage.get_tagged_manifests("estimate-first")["1"]
+            self.assertEqual(estimate.shared_bytes, storage.get_blob_size(shared) + 10, "Blobs shared between repos are counted once")
+            self.assertNotIn("estimate-third", estimate.repositories, "Image referenced by kept tag is not reclaimable")
+            self.assertGreaterEqual(estimate.total_bytes, estimate.shared_bytes)
+    
+    def test_time_budget_schedule(self):
+        with fixtures._app(self._get_repositories_config(1)) as app:
+            with app._native.run():
+                with fixtures._registry() as r:
+                    r.upload_fake_image('schedule-small', '2', b'2020202012')
+                    r.upload_fake_image('schedule-small', '1', b'2020202011')
+                    r.upload_fake_image('schedule-big', '2', b'2020202022')
+                    r.upload_fake_image('schedule-big', '1', b'20202020210' * 1000)
+            
+            schedule = app.get_schedule()
+            self.assertLess(schedule.index('schedule-big'), schedule.index('schedule-small'), "Repository with more reclaimable space is first")
+            
+            with tempfile.TemporaryDirectory() as d:
+                state_path = os.path.join(d, "state.json")
+                
+                app.clean(offline=True, gc="native", time_budget=0, state_path=state_path)
+                with open(state_path) as f:
+                    pending = json.load(f)["pending"]
+                self.assertEqual(pending, schedule[1:], "Only first repository is cleaned when budget is exceeded")
+                
+                app.clean(offline=True, gc="native", time_budget=0, state_path=state_path)
+                with open(state_path) as f:
+                    self.assertEqual(json.load(f)["pending"][:len(pending) - 1], pending[1:], "Next run resumes from saved position")
+                
+                app.clean(offline=True, gc="native", state_path=state_path)
+                self.assertFalse(os.path.exists(state_path), "State is removed after complete run")
+            
+            self.assertEqual(app.list_repos()["schedule-small"], ("2",))
+            
+            get_schedule = app.get_schedule
+            storage_clean = app._storage_untagger.clean
+            times = {}
+            def timed_get_schedule(*args, **kwargs):
+                schedule = get_schedule(*args, **kwargs)
+                times["scheduled"] = time.monotonic()
+                return schedule
+            def recording_clean(pretend, jobs, repositories, deadline, journal):
+                times["deadline"] = deadline
+                return storage_clean(pretend, jobs, repositories, deadline, journal)
+            app.get_schedule = timed_get_schedule
+            app._storage_untagger.clean = recording_clean
+            
+            app.clean(offline=True, gc="native", time_budget=60)
+            self.assertGreaterEqual(times["deadline"], times["scheduled"] + 60, "Budget is counted after scheduling")
+    
+    def test_resume_from_journal(self):
+        fake_tag = "untagger-for-deletion"
+        with fixtures._app(self._get_repositories_config(1)) as app:
+            with app._native.run():
+                with fixtures._registry() as r:
+                    r.upload_fake_image('journal-done', '2', b'2121212122')
+                    r.upload_fake_image('journal-done', '1', b'2121212121')
+                    r.upload_fake_image('journal-interrupted', '3', b'2121212133')
+                    r.upload_fake_image('journal-interrupted', '2', b'2121212132')
+                    r.upload_fake_image('journal-interrupted', '1', b'2121212131')
+                    # run was killed after moving one of tags to fake image
+                    fake_ref = r.upload_fake_image('journal-interrupted', fake_tag, b'2121212130')
+                    r.tag('journal-interrupted', fake_tag, '1')
+            
+            with tempfile.TemporaryDirectory() as d:
+                journal_path = os.path.join(d, "journal.jsonl")
+                with open(journal_path, "wt") as f:
+                    f.write(json.dumps({"event": "done", "repository": "journal-done"}) + "\n")
+                    f.write(json.dumps({"event": "fake_uploaded", "repository": "journal-interrupted", "digest": fake_ref}) + "\n")
+                
+                app.clean(journal_path=journal_path)
+                self.assertFalse(os.path.exists(journal_path), "Journal is removed after complete run")
+            
+            repos = app.list_repos()
+            self.assertEqual(repos["journal-done"], ("1", "2"), "Finished repository is skipped")
+            self.assertEqual(repos["journal-interrupted"], ("3",), "Fake image is removed and interrupted repository is finished")
+    
+    def test_failed_repository(self):
+        with fixtures._app(self._get_repositories_config(1)) as app:
+            with app._native.run():
+                with fixtures._registry() as r:
+                    r.upload_fake_image('failing-broken', '2', b'2222222222')
+                    r.upload_fake_image('failing-broken', '1', b'2222222221')
+                    r.upload_fake_image('failing-other', '2', b'2222222232')
+                    r.upload_fake_image('failing-other', '1', b'2222222231')
+            
+            delete_tags = app._untagger.delete_tags
+            def failing_delete_tags(registry, repo, *args, **kwargs):
+                if repo == 'failing-broken':
+                    raise Exception("Broken repository")
+                return delete_tags(registry, repo, *args, **kwargs)
+            app._untagger.delete_tags = failing_delete_tags
+            
+            with tempfile.TemporaryDirectory() as d:
+                journal_path = os.path.join(d, "journal.jsonl")
+                with self.assertRaises(app_module.CleaningFailed) as cm:
+                    app.clean(gc="registry", jobs=2, journal_path=journal_path)
+                self.assertFalse(os.path.exists(journal_path), "Journal of pass that visited all repositories is removed")
+            
+            self.assertEqual(list(cm.exception.failed.keys()), ['failing-broken'])
+            self.assertEqual(app.list_repos()["failing-other"], ("2",), "Other repositories are cleaned")
+            self.assertEqual(app.metrics.get_report()["stages"]["registry_gc"]["runs"], 2, "Garbage is collected despite failure")
+    
+    def test_pretend_garbage_collect(self):
+        with fixtures._app(self._get_repositories_config(1)) as app:
+            with app._native.run():
+                with fixtures._registry() as r:
+                    r.upload_fake_image('dry-run-gc', '2', b'1919191912')
+                    r.upload_fake_image('dry-run-gc', '1', b'1919191911')
+            
+            blobs = set(app._storage.iter_blobs())
+            estimate = app.clean(pretend=True, offline=True)
+            gc_result = estimate.garbage_collect
+            
+            self.assertEqual(set(app._storage.iter_blobs()), blobs, "Nothing is removed")
+            self.assertGreaterEqual(gc_result.freed_bytes, estimate.total_bytes)
+            self.assertGreaterEqual(gc_result.deleted_blobs, estimate.blobs)
+            
+            app.clean(offline=True, gc="native")
+            self.assertEqual(app.metrics.get_counter("freed_bytes_total", source="gc"), gc_result.freed_bytes, "Dry run predicts collected garbage")
+            self.assertEqual(app.metrics.get_counter("blobs_deleted_total"), gc_result.deleted_blobs)
+    
+    def test_cli_saves_manifest_cache(self):
+        with fixtures._app(self._get_repositories_config(1)) as app:
+            with app._native.run():
+                with fixtures._registry() as r:
+                    r.upload_fake_image('cli-cache', '2', b'2020202022')
+                    r.upload_fake_image('cli-cache', '1', b'2020202021')
+        
+        with tempfile.TemporaryDirectory() as d:
+            cache_path = "%s/manifests.json" % d
+            config = fixtures.generate_config(self._get_repositories_config(1), {"cache": {"path": cache_path}})
+            try:
+                Cli().run([
+                    "-d", os.environ.get("REGISTRY_DATA", "/var/lib/registry"),
+                    "-b", os.environ.get("REGISTRY_BIN", "registry"),
+                    config, "clean"
+                ])
+            finally:
+                os.unlink(config)
+            
+            self.assertTrue(os.path.exists(cache_path), "Manifest cache is saved after CLI run")
+    
+    def test_small_selection_skips_digests(self):
+        with fixtures._app(self._get_repositories_config(3)) as app:
+            with app._native.run():
+                with fixtures._registry() as r:
+                    for i in range(1, 5):
+                        r.upload_fake_image('small-selection', '%d' % i, b'212121212%d' % i)
+            
+            split_by_digest = app._untagger._split_by_digest
+            splits = []
+            def recording_split_by_digest(registry, repo, *args, **kwargs):
+                splits.append(repo)
+                return split_by_digest(registry, repo, *args, **kwargs)
+            app._untagger._split_by_digest = recording_split_by_digest
+            
+            app.clean()
+            self.assertEqual(app.list_repos()["small-selection"], ("2", "3", "4"), "Selected tag is removed")
+            self.assertEqual(splits, [], "Digests of all tags are not resolved for small selection")
@@ -0,0 +1,157 @@
+'''
+.. moduleauthor:: Arkadiusz Dzięgiel <arkadiusz.dziegiel@glorpen.pl>
+'''
+import unittest
+import tempfile
+import hashlib
+import threading
+import http.server
+import socketserver
+import requests
+from glorpen.docker_registry_cleaner import api
+
+def _manifest(i):
+    data = ('{"schemaVersion": 2, "size": %d}' % i).encode()
+    return "sha256:%s" % hashlib.sha256(data).hexdigest(), "application/json", data
+
+class TestManifestCache(unittest.TestCase):
+    
+    def test_eviction(self):
+        manifests = [_manifest(i) for i in range(4)]
+        cache = api.ManifestCache(max_size=len(manifests[0][2]) * 2)
+        
+        cache.set(*manifests[0])
+        cache.set(*manifests[1])
+        cache.get(manifests[0][0])
+        cache.set(*manifests[2])
+        
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get(manifests[1][0]))
+        self.assertEqual(cache.get(manifests[0][0]), manifests[0][1:])
+    
+    def test_references(self):
+        cache = api.ManifestCache(max_references=2)
+        cache.set_reference("repo", "1", "sha256:a")
+        cache.set_reference("repo", "2", "sha256:b")
+        cache.set_reference("other", "1", "sha256:a")
+        
+        self.assertIsNone(cache.get_reference("repo", "1"))
+        
+        cache.remove_references("repo", "sha256:b")
+        self.assertIsNone(cache.get_reference("repo", "2"))
+        self.assertEqual(cache.get_reference("other", "1"), "sha256:a")
+        
+        cache.set_reference("other", "2", "sha256:a")
+        cache.set_reference("other", "1", "sha256:c")
+        cache.remove_references("other", "sha256:a")
+        self.assertIsNone(cache.get_reference("other", "2"))
+        self.assertEqual(cache.get_reference("other", "1"), "sha256:c", "Moved tag is kept")
+        self.assertEqual(cache._tags, {("other", "sha256:c"): {"1"}}, "Index is cleaned with references")
+    
+    def test_persistence(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = "%s/cache.json" % d
+            digest, media_type, data = _manifest(1)
+            
+            cache = api.ManifestCache(path=path)
+            cache.set(digest, media_type, data)
+            cache.set("sha256:invalid", media_type, data)
+            cache.set(*_manifest(2), persistent=False)
+            cache.set_reference("repo", "1", digest)
+            cache.save()
+            
+            cache = api.ManifestCache(path=path)
+            self.assertEqual(len(cache), 1, "Only valid manifests used by next runs are loaded")
+            self.assertEqual(cache.get(digest), (media_type, data))
+            self.assertIsNone(cache.get_reference("repo", "1"))
+
+class _FlakyHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    
+    def _respond(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.server.requests.append(self.command)
+        status = self.server.statuses.pop(0) if self.server.statuses else 200
+        body, link = self.server.pages.pop(0) if self.server.pages and self.command == "GET" else (b"{}", None)
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        if link:
+            self.send_header("Link", link)
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+    
+    do_GET = do_HEAD = do_PUT = do_POST = _respond
+    
+    def log_message(self, *args):
+        pass
+
+class _ThreadingServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+class TestDockerRegistryRetries(unittest.TestCase):
+    
+    def setUp(self):
+        self.server = _ThreadingServer(("127.0.0.1", 0), _FlakyHandler)
+        self.server.requests = []
+        self.server.statuses = []
+        self.server.pages = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.registry = api.DockerRegistry("http://127.0.0.1:%d" % self.server.server_address[1], retries=2, backoff=0.01)
+    
+    def tearDown(self):
+        self.registry.close()
+        self.server.shutdown()
+        self.server.server_close()
+    
+    def test_idempotent_requests_are_retried(self):
+        self.server.statuses = [503, 502]
+        self.assertTrue(self.registry.check())
+        
+        self.server.statuses = [503]
+        self.registry._put_manifest("repo", "tag", ("application/json", b"{}"))
+        
+        self.assertEqual(self.server.requests, ["HEAD", "HEAD", "HEAD", "PUT", "PUT"])
+        self.assertEqual(self.registry.get_connection_stats(), {"requests": 5, "connections": 1, "retries": 3})
+    
+    def test_other_requests_are_not_retried(self):
+        self.server.statuses = [503]
+        self.assertEqual(self.registry._api("repo/blobs/uploads/", method="post").status_code, 503)
+        self.assertEqual(self.server.requests, ["POST"])
+    
+    def test_missing_reference(self):
+        self.server.statuses = [404]
+        with self.assertRaises(requests.HTTPError) as cm:
+            self.registry.get_reference("repo", "missing")
+        self.assertEqual(cm.exception.response.status_code, 404)
+        self.assertEqual(self.server.requests, ["HEAD"])
+    
+    def test_failed_page(self):
+        self.server.statuses = [200, 500, 500, 500]
+        self.server.pages = [(b'{"tags": ["1", "2"]}', '</v2/repo/tags/list?last=2>; rel="next"')]
+        with self.assertRaises(requests.HTTPError):
+            self.registry.get_tags("repo")
+        self.assertEqual(self.server.requests, ["GET"] * 4)
+    
+    def test_missing_tags(self):
+        self.server.statuses = [404]
+        self.assertEqual(self.registry.get_tags("repo"), ())
+    
+    def test_pool_sized_for_workers(self):
+        registry = api.DockerRegistry(self.registry._url, concurrency=2)
+        registry.set_workers(4)
+        
+        def _check():
+            for _i in range(10):
+                registry.check()
+        
+        threads = [threading.Thread(target=_check) for _i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        
+        stats = registry.get_connection_stats()
+        registry.close()
+        self.assertEqual(stats["requests"], 80)
+        self.assertLessEqual(stats["connections"], 8, "Connections are kept for every concurrent request")
@@ -0,0 +1,44 @@
+'''
+.. moduleauthor:: Arkadiusz Dzięgiel <arkadiusz.dziegiel@glorpen.pl>
+'''
+import unittest
+import tempfile
+import os
+from glorpen.docker_registry_cleaner.journal import Journal
+
+class TestJournal(unittest.TestCase):
+    
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self._dir.name, "journal.jsonl")
+    
+    def tearDown(self):
+        self._dir.cleanup()
+    
+    def test_resume(self):
+        journal = Journal(self.path)
+        journal.fake_uploaded("a", "sha256:fake-a")
+        journal.fake_removed("a")
+        journal.done("a")
+        journal.fake_uploaded("b", "sha256:fake-b")
+        journal.close()
+        
+        with open(self.path, "at") as f:
+            f.write('{"event": "done", "repos')
+        
+        journal = Journal(self.path)
+        self.assertTrue(journal.is_done("a"))
+        self.assertFalse(journal.is_done("b"), "Incomplete entry is ignored")
+        self.assertEqual(journal.get_fake_images(), {"b": "sha256:fake-b"})
+        
+        journal.done("b")
+        journal.close()
+        
+        self.assertTrue(Journal(self.path).is_done("b"), "Entry written after incomplete one can be read")
+    
+    def test_remove(self):
+        journal = Journal(self.path)
+        journal.done("a")
+        journal.remove()
+        
+        self.assertFalse(os.path.exists(self.path))
@@ -0,0 +1,47 @@
+'''
+.. moduleauthor:: Arkadiusz Dzięgiel <arkadiusz.dziegiel@glorpen.pl>
+'''
+import unittest
+from glorpen.docker_registry_cleaner.metrics import Metrics
+
+class TestMetrics(unittest.TestCase):
+    
+    def _get_metrics(self):
+        m = Metrics()
+        with m.stage("untagging"):
+            pass
+        with m.stage("untagging"):
+            pass
+        m.inc("tags_selected_total", 3, repository="a")
+        m.inc("repositories_failed_total")
+        m.inc("tags_selected_total", 2, repository='b"c')
+        m.observe("http_request_duration_seconds", 0.02, endpoint="manifests", method="GET")
+        m.observe("http_request_duration_seconds", 20, endpoint="manifests", method="GET")
+        return m
+    
+    def test_report(self):
+        report = self._get_metrics().get_report()
+        
+        self.assertEqual(report["stages"]["untagging"]["runs"], 2)
+        self.assertEqual(report["counters"]["tags_selected_total"][1], {"labels": {"repository": 'b"c'}, "value": 2})
+        
+        h = report["histograms"]["http_request_duration_seconds"][0]
+        self.assertEqual((h["count"], h["buckets"]["0.01"], h["buckets"]["0.025"], h["buckets"]["10"]), (2, 0, 1, 1))
+    
+    def test_counters(self):
+        m = self._get_metrics()
+        
+        self.assertEqual(m.get_counter("tags_selected_total"), 5)
+        self.assertEqual(m.get_counter("tags_selected_total", repository="a"), 3)
+        self.assertEqual(m.get_counter("missing"), 0)
+    
+    def test_prometheus_text(self):
+        lines = self._get_metrics().get_prometheus_text().splitlines()
+        
+        self.assertIn('registry_cleaner_stage_runs{stage="untagging"} 2', lines)
+        self.assertIn('registry_cleaner_tags_selected_total{repository="b\\"c"} 2', lines)
+        self.assertIn('registry_cleaner_http_request_duration_seconds_bucket{endpoint="manifests",method="GET",le="+Inf"} 2', lines)
+        
+        indexes = [i for i, l in enumerate(lines) if l.startswith("registry_cleaner_tags_selected_total")]
+        self.assertEqual(indexes, list(range(indexes[0], indexes[0] + 2)), "Samples of metric are grouped")
+        self.assertEqual(lines.count("# TYPE registry_cleaner_tags_selected_total counter"), 1)
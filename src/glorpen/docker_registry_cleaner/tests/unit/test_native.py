@@ -0,0 +1,182 @@
+'''
+.. moduleauthor:: Arkadiusz Dzięgiel <arkadiusz.dziegiel@glorpen.pl>
+'''
+import unittest
+import tempfile
+import os
+import shutil
+import hashlib
+import json
+from glorpen.docker_registry_cleaner import native
+
+class TestRegistryStorage(unittest.TestCase):
+    
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self.storage = native.RegistryStorage(self._dir.name)
+    
+    def tearDown(self):
+        self._dir.cleanup()
+    
+    def _create_repository(self, name, tags=()):
+        path = self.storage._get_repository_path(name)
+        os.makedirs(path + "/_manifests/tags")
+        os.makedirs(path + "/_layers/sha256/aa")
+        os.makedirs(path + "/_uploads/some-uuid")
+        for tag in tags:
+            os.makedirs("%s/_manifests/tags/%s/current" % (path, tag))
+    
+    def _setup_repositories(self):
+        self._create_repository("a", ["latest"])
+        self._create_repository("a/nested")
+        self._create_repository("b/c/d", ["1.0"])
+        self._create_repository("e")
+    
+    def test_iter_repositories(self):
+        self._setup_repositories()
+        
+        self.assertEqual(self.storage.get_repositories(), ("a", "a/nested", "b/c/d", "e"))
+        self.assertEqual(set(self.storage.iter_repositories(jobs=4)), {"a", "a/nested", "b/c/d", "e"})
+    
+    def test_missing_repositories_dir(self):
+        self.assertEqual(self.storage.get_repositories(), ())
+        self.assertEqual(self.storage.remove_repositories_without_tags(jobs=4), 0)
+    
+    def test_remove_repositories_without_tags(self):
+        self._setup_repositories()
+        
+        self.assertEqual(self.storage.remove_repositories_without_tags(jobs=4), 2)
+        self.assertEqual(self.storage.get_repositories(), ("a", "b/c/d"))
+    
+    def test_purge_uploads(self):
+        self._setup_repositories()
+        uploads_path = self.storage._get_uploads_path("b/c/d")
+        os.makedirs(uploads_path + "/stale")
+        with open(uploads_path + "/stale/startedat", "wt") as f:
+            f.write("2019-04-04T10:00:00Z")
+        with open(uploads_path + "/stale/data", "wb") as f:
+            f.write(b"x" * 100)
+        
+        result = self.storage.purge_uploads(3600, jobs=4)
+        
+        self.assertEqual((result.removed_uploads, result.freed_bytes), (1, 120))
+        self.assertEqual(os.listdir(uploads_path), ["some-uuid"])
+
+class TestGarbageCollectProgress(unittest.TestCase):
+    
+    output = [
+        "a",
+        "a: marking manifest sha256:m1 ",
+        "a: marking blob sha256:b1",
+        "a: marking blob sha256:b2",
+        "b/c",
+        "b/c: marking manifest sha256:m2 ",
+        "a: marking blob sha256:b3",
+        "manifest eligible for deletion: sha256:m3",
+        'time="2019-04-04T10:00:00Z" level=info msg="deleting manifest: /docker/registry/v2/repositories/b/c/_manifests/revisions/sha256/m3"',
+        "",
+        "3 blobs marked, 2 blobs and 1 manifests eligible for deletion",
+        "blob eligible for deletion: sha256:b4",
+        'time="2019-04-04T10:00:00Z" level=info msg="Deleting blob: /docker/registry/v2/blobs/sha256/b4/b4"',
+    ]
+    
+    def test_parsing(self):
+        clock = iter(range(100))
+        progress = native.GarbageCollectProgress(repositories=4, interval=60, clock=lambda: next(clock))
+        
+        for line in self.output[:6]:
+            progress.feed(line)
+        
+        self.assertEqual((progress.phase, progress.scanned_repositories, progress.marked_manifests, progress.marked_blobs), ("mark", 2, 2, 2))
+        self.assertIsNotNone(progress.get_eta())
+        
+        for line in self.output[6:]:
+            progress.feed(line)
+        
+        self.assertEqual(progress.phase, "sweep")
+        self.assertEqual((progress.eligible_blobs, progress.eligible_manifests), (2, 1))
+        self.assertEqual(progress.format_progress()[:48], "Sweeping: 1/2 blobs deleted, 1 manifests deleted")
+        
+        result = progress.get_result()
+        self.assertEqual(
+            (result.scanned_repositories, result.marked_manifests, result.marked_blobs, result.deleted_blobs, result.deleted_manifests),
+            (2, 2, 3, 1, 1)
+        )
+        self.assertEqual((result.eligible_blobs, result.eligible_manifests), (2, 1))
+    
+    def test_unknown_eta(self):
+        progress = native.GarbageCollectProgress()
+        progress.feed("a")
+        self.assertIsNone(progress.get_eta())
+
+class TestGarbageCollector(unittest.TestCase):
+    
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self.storage = native.RegistryStorage(self._dir.name)
+        self.gc = native.GarbageCollector(self.storage)
+        self.index_path = os.path.join(self._dir.name, "index.sqlite")
+    
+    def tearDown(self):
+        self._dir.cleanup()
+    
+    def _write(self, path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(data)
+    
+    def _put_blob(self, data):
+        digest = "sha256:%s" % hashlib.sha256(data).hexdigest()
+        self._write(self.storage._get_blob_path(digest), data)
+        return digest
+    
+    def _put_image(self, repository, tag, data):
+        layer = self._put_blob(data)
+        manifest = self._put_blob(json.dumps({"schemaVersion": 2, "layers": [{"digest": layer}]}).encode())
+        self._write("%s/sha256/%s/link" % (self.storage._get_revisions_path(repository), manifest[7:]), manifest.encode())
+        self._write("%s/%s/current/link" % (self.storage._get_tags_path(repository), tag), manifest.encode())
+        return layer
+    
+    def _count_listings(self):
+        listed = []
+        iter_prefix_blobs = self.storage.iter_prefix_blobs
+        def _iter_prefix_blobs(prefix):
+            listed.append(prefix)
+            return iter_prefix_blobs(prefix)
+        self.storage.iter_prefix_blobs = _iter_prefix_blobs
+        return listed
+    
+    def test_incremental_collect(self):
+        layer = self._put_image("a", "1", b"layer-a")
+        self._put_image("b", "1", b"layer-b")
+        self._put_blob(b"orphan")
+        
+        self.assertEqual(self.gc.collect(jobs=2, index_path=self.index_path).deleted_blobs, 1)
+        
+        listed = self._count_listings()
+        result = self.gc.collect(jobs=2, index_path=self.index_path)
+        self.assertEqual((result.unchanged_repositories, result.deleted_blobs), (2, 0))
+        self.assertEqual(listed, [], "Unchanged blob directories are not listed")
+        
+        orphan = self._put_blob(b"new orphan")
+        shutil.rmtree("%s/1" % self.storage._get_tags_path("a"))
+        added = [orphan, self._put_image("a", "2", b"layer-a2")]
+        added.append(self.storage.get_tagged_manifests("a")["2"])
+        result = self.gc.collect(jobs=2, index_path=self.index_path)
+        
+        self.assertEqual(result.unchanged_repositories, 1)
+        self.assertEqual(set(listed), set(self.storage.get_blob_prefix(i) for i in added), "Only directories with new blobs are listed")
+        self.assertNotIn(orphan, set(self.storage.iter_blobs()), "New unreferenced blob is collected")
+        self.assertNotIn(layer, set(self.storage.iter_blobs()), "Blob released by changed repository is collected")
+    
+    def test_dry_run_keeps_index(self):
+        self._put_image("a", "1", b"layer-a")
+        self.gc.collect(jobs=2, index_path=self.index_path)
+        with open(self.index_path, "rb") as f:
+            index = f.read()
+        
+        result = self.gc.collect(jobs=2, index_path=self.index_path, dry_run=True, removed_tags={"a": ["1"]})
+        
+        self.assertEqual((result.removed_repositories, result.deleted_blobs), (1, 2))
+        with open(self.index_path, "rb") as f:
+            self.assertEqual(f.read(), index, "Index is not modified")
@@ -0,0 +1,105 @@
+'''
+.. moduleauthor:: Arkadiusz Dzięgiel <arkadiusz.dziegiel@glorpen.pl>
+'''
+import unittest
+import re
+from collections import OrderedDict
+from glorpen.docker_registry_cleaner import api
+from glorpen.docker_registry_cleaner.selectors import simple, semver
+
+class TestSelectTags(unittest.TestCase):
+    
+    def _get_repository(self, *selectors):
+        return api.DockerRepository("test", ["*"], OrderedDict(("s%d" % i, s) for i, s in enumerate(selectors)))
+    
+    def _get_pattern_config(self):
+        return simple.PatternSelectorConfig({
+            "latest": ["latest"],
+            "ci": OrderedDict([("r-([0-9]+)", "\\1"), ("build-([0-9]+)", "\\1")]),
+        })
+    
+    def test_max_selector(self):
+        repo = self._get_repository(simple.MaxSelector({"max_items": 2}))
+        self.assertEqual(repo.select_tags(["1", "2", "3", "4"]), {"1", "2"})
+    
+    def test_chained_selectors(self):
+        config = self._get_pattern_config()
+        repo = self._get_repository(
+            simple.PatternSelector({"pattern": "latest"}, config),
+            simple.PatternSelector({"pattern": "ci", "max_items": 2}, config),
+            simple.MaxSelector({"max_items": 1}),
+        )
+        tags = ["latest", "r-1", "r-10", "build-9", "r-2", "other-a", "other-b"]
+        self.assertEqual(repo.select_tags(tags), {"r-1", "r-2", "other-a"})
+    
+    def test_unmatched_tags_are_kept(self):
+        config = self._get_pattern_config()
+        repo = self._get_repository(simple.PatternSelector({"pattern": "ci", "max_items": 0}, config))
+        self.assertEqual(repo.select_tags(["r-1", "latest"]), {"r-1"})
+
+class TestPatternMatcher(unittest.TestCase):
+    
+    def _assert_same_as_sequential(self, patterns, texts):
+        matcher = simple.PatternMatcher(tuple((re.compile(p), r) for p, r in patterns))
+        for text in texts:
+            self.assertEqual(matcher.match(text), matcher._match_sequential(text), "Same result for %r" % text)
+        return matcher
+    
+    def test_combined(self):
+        matcher = self._assert_same_as_sequential(
+            [("r-([0-9]+)", "\\1"), ("build-(?P<num>[0-9]+)-([a-z]+)", "\\2\\g<num>\\g<0>"), ("latest", None), ("(v)?x-([0-9]+)", "\\g<2>")],
+            ["r-1", "r-12", "build-3-abc", "latest", "latest-2", "other", "x-5", "vx-6", "r-1r-2", "r-", ""]
+        )
+        self.assertIsNotNone(matcher._combined, "Patterns are combined")
+        self.assertEqual(matcher.match("build-3-abc"), "abc3build-3-abc")
+    
+    def test_not_combined(self):
+        for pattern in ["(a)\\1", "(?i)abc", "a\\b", "(?<=a)b"]:
+            matcher = self._assert_same_as_sequential([(pattern, "x"), ("r-([0-9]+)", "\\1")], ["aa", "ABC", "a", "ab", "r-1"])
+            self.assertIsNone(matcher._combined, "Pattern %r is not combined" % pattern)
+    
+    def test_empty_matches(self):
+        self._assert_same_as_sequential([("([0-9]*)", "v\\1"), ("(.*)", "\\1")], ["123", "abc", "1a"])
+    
+    def test_invalid_templates(self):
+        matcher = simple.PatternMatcher(((re.compile("(?P<a>a)"), "x"), (re.compile("b"), "\\g<a>")))
+        self.assertIsNone(matcher._combined, "Groups from other patterns are not used")
+        self.assertEqual(matcher.match("a"), "x")
+
+class TestSemVerSelector(unittest.TestCase):
+    
+    def _expression(self, value):
+        return semver.ConfigExpressionField().resolve(value).resolve(None)
+    
+    def _get_selector(self):
+        return semver.SemVerSelector({"groups": OrderedDict([
+            ("current_minor", {
+                "where": {"major": self._expression("latest"), "minor": self._expression("latest")},
+                "preserve": {"major": None, "minor": None, "patch": 2},
+            }),
+            ("archival", {
+                "where": {"major": self._expression({"min": None, "max": "latest - 1"})},
+                "preserve": {"major": None, "minor": 1, "patch": None},
+            }),
+        ])})
+    
+    def test_groups(self):
+        tags = ["2.1.3", "2.1.2+build", "2.1.2", "2.1.1", "2.0.9", "1.5.0", "1.4.0", "0.1.0", "latest"]
+        selected, unmatched = self._get_selector().select(tags)
+        
+        self.assertEqual(set(selected), {"2.1.3", "2.1.2+build", "2.1.2", "1.5.0", "0.1.0"})
+        self.assertEqual(unmatched, ["latest"])
+    
+    def test_parsing_is_cached(self):
+        self.assertIs(semver.parse_version("1.2.3"), semver.parse_version("1.2.3"))
+        self.assertEqual(semver.parse_version("1.2.3-rc.1+b1").key, (1, 2, 3))
+        self.assertIsNone(semver.parse_version("v1.2.3"))
+    
+    def test_where_ranges_bisection(self):
+        selector = self._get_selector()
+        versions = sorted([(2, 1, 3), (2, 1, 0), (2, 0, 9), (1, 5, 0), (1, 4, 2), (1, 4, 0), (0, 1, 0)])
+        
+        self.assertEqual(list(selector._find_versions(versions, ((1, 1), (4, 4)))), [(1, 4, 0), (1, 4, 2)])
+        self.assertEqual(list(selector._find_versions(versions, ((None, 1),))), [(0, 1, 0), (1, 4, 0), (1, 4, 2), (1, 5, 0)])
+        self.assertEqual(list(selector._find_versions(versions, ((None, None), (1, None)))), [(0, 1, 0), (1, 4, 0), (1, 4, 2), (1, 5, 0), (2, 1, 0), (2, 1, 3)])
+        self.assertEqual(list(selector._find_versions(versions, ())), versions)